@@ -1,8 +1,12 @@
 import os
+import io
 import json
+import array
 import pickle
+import hashlib
 import collections
 import re
+import multiprocessing
 from nltk.tokenize import word_tokenize
 from torchtext.vocab import GloVe
 from config import Config
@@ -20,7 +24,254 @@ def is_number(s):
 pat = re.compile(r"[\w]+|[.,!?;|]")
 
 
+# Tokenize the titles and abstracts of a chunk of news [(news_ID, title, abstract)], the words are counted in the order of appearance with numbers counted as <NUM>
+def tokenize_news(news: list, tokenizer: str):
+    tokenized_news = []
+    word_counter = collections.Counter()
+    for news_ID, title, abstract in news:
+        title_words = pat.findall(title.lower()) if tokenizer == 'MIND' else word_tokenize(title.lower())
+        abstract_words = pat.findall(abstract.lower()) if tokenizer == 'MIND' else word_tokenize(abstract.lower())
+        for word in title_words + abstract_words:
+            word_counter['<NUM>' if is_number(word) else word] += 1
+        tokenized_news.append((news_ID, title_words, abstract_words))
+    return tokenized_news, word_counter
+
+
+# Tokenize news [(news_ID, title, abstract)] in chunks by a pool of process_num processes (0 for the CPU count)
+# The chunk word counters are merged in the chunk order, so that the words of the merged counter are in the same order of first appearance as counting sequentially
+# Output
+# tokenized_news : {news_ID: (title_words, abstract_words)}
+# word_counter   : Counter of the words, with numbers counted as <NUM>
+def parallel_tokenize_news(news: list, tokenizer: str, process_num: int):
+    process_num = process_num if process_num > 0 else os.cpu_count()
+    chunk_size = max((len(news) + process_num * 4 - 1) // (process_num * 4), 1)
+    chunks = [news[i: i + chunk_size] for i in range(0, len(news), chunk_size)]
+    if process_num > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(process_num, len(chunks))) as pool:
+            chunk_results = pool.starmap(tokenize_news, [(chunk, tokenizer) for chunk in chunks])
+    else:
+        chunk_results = [tokenize_news(chunk, tokenizer) for chunk in chunks]
+    tokenized_news = {}
+    word_counter = collections.Counter()
+    for chunk_tokenized_news, chunk_word_counter in chunk_results:
+        for news_ID, title_words, abstract_words in chunk_tokenized_news:
+            tokenized_news[news_ID] = (title_words, abstract_words)
+        word_counter.update(chunk_word_counter)
+    return tokenized_news, word_counter
+
+
+# Stream a GloVe text file once and keep only the vectors of the vocabulary words, the mean vector of all GloVe vectors is accumulated on the way
+# The filtered vectors are cached in a file keyed by the hash of the vocabulary, so that the GloVe file is read once for a vocabulary
+# Output
+# glove_stoi        : {word: row in glove_vectors} of the vocabulary words found in GloVe
+# glove_vectors     : [len(glove_stoi), dim]
+# glove_mean_vector : [dim]
+def load_glove(glove_file: str, dim: int, vocabulary: dict):
+    vocabulary_hash = hashlib.md5('\n'.join(sorted(vocabulary)).encode('utf-8')).hexdigest()[:16]
+    glove_cache_file = os.path.basename(glove_file)[:-len('.txt')] + '-' + vocabulary_hash + '.pkl'
+    if not os.path.exists(glove_cache_file):
+        glove_stoi = {}
+        glove_vectors = []
+        glove_vector_sum = np.zeros([dim], dtype=np.float64)
+        glove_num = 0
+        with open(glove_file, 'r', encoding='utf-8') as glove_f:
+            for line in glove_f:
+                terms = line.rstrip().rsplit(' ', dim) # a few GloVe words contain spaces
+                if len(terms) != dim + 1:
+                    continue
+                vector = np.array(terms[1:], dtype=np.float32)
+                glove_vector_sum += vector
+                glove_num += 1
+                if terms[0] in vocabulary:
+                    if terms[0] in glove_stoi: # the last vector of a duplicated word is kept as torchtext does
+                        glove_vectors[glove_stoi[terms[0]]] = vector
+                    else:
+                        glove_stoi[terms[0]] = len(glove_vectors)
+                        glove_vectors.append(vector)
+        with open(glove_cache_file + '.tmp', 'wb') as glove_cache_f:
+            pickle.dump({
+                'glove_stoi': glove_stoi,
+                'glove_vectors': np.array(glove_vectors, dtype=np.float32).reshape([-1, dim]),
+                'glove_mean_vector': (glove_vector_sum / max(glove_num, 1)).astype(np.float32)
+            }, glove_cache_f)
+        os.replace(glove_cache_file + '.tmp', glove_cache_file) # renamed when complete, so that an interrupted run rereads the GloVe file
+    with open(glove_cache_file, 'rb') as glove_cache_f:
+        glove = pickle.load(glove_cache_f)
+    return glove['glove_stoi'], torch.from_numpy(glove['glove_vectors']), torch.from_numpy(glove['glove_mean_vector'])
+
+
+# Read the embeddings of the .vec files of the splits into an embedding matrix of the entities in entity_dict (zeros for the entities without embedding)
+# The lines are read in reverse order and each entity is kept at its first occurrence, i.e., the last vector of an entity is kept as assigning the lines in order,
+# the vectors of the kept lines are parsed by numpy in one call and scattered into the matrix in one assignment
+# Output
+# embedding_vectors : [len(entity_dict), dim]
+def load_entity_embedding(vec_files: list, entity_dict: dict, dim: int, name: str):
+    entity_vector_lines = {} # {entity index: vector line}
+    for vec_file in reversed(vec_files):
+        with open(vec_file, 'r', encoding='utf-8') as vec_f:
+            for line in reversed(vec_f.readlines()):
+                terms = line.strip().split('\t', 1)
+                if len(terms) == 2 and terms[0] in entity_dict:
+                    entity_vector_lines.setdefault(entity_dict[terms[0]], terms[1])
+    embedding_vectors = np.zeros([len(entity_dict), dim], dtype=np.float32)
+    if len(entity_vector_lines) > 0:
+        vectors = np.loadtxt(io.StringIO('\n'.join(entity_vector_lines.values())), dtype=np.float32, delimiter='\t', comments=None, ndmin=2) # [len(entity_vector_lines), dim]
+        assert vectors.shape[1] == dim, name + ' embedding dim does not match'
+        embedding_vectors[np.fromiter(entity_vector_lines.keys(), dtype=np.int64, count=len(entity_vector_lines))] = vectors
+    return torch.from_numpy(embedding_vectors)
+
+
+# Move the data of a numpy array into shared memory, the returned array is a view of it
+# The DataLoader workers then read the corpus tables from the shared pages, so that the worker RSS does not grow with copies of the tables
+def share_memory(table: np.ndarray):
+    return torch.from_numpy(np.ascontiguousarray(table)).share_memory_().numpy()
+
+
+# Whether a cache written with its meta file last is complete and was built from the same source (the meta fields other than the built statistics are compared)
+def cache_exists(meta_file: str, meta: dict):
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, 'r', encoding='utf-8') as meta_f:
+        cached_meta = json.load(meta_f)
+    return all(cached_meta.get(key) == value for key, value in meta.items())
+
+
+# Columnar (struct-of-arrays) store of the behaviors of a split, each impression references its user history and its candidates by offsets into flat arrays,
+# the histories are truncated to the last max_history_num news, and the repeated history of a user is stored once
+class MIND_Behaviors:
+    columns = ['impression_ID', 'user_index', 'user_key', 'history_offset', 'history_length', 'history_news', 'candidate_offsets', 'candidate_news', 'candidate_labels']
+
+    def __init__(self, max_history_num: int):
+        self.max_history_num = max_history_num
+        self.user_history_span = {}                  # {user_key: (history_offset, history_length)} of the last history of the user
+        self.impression_ID = array.array('q')        # [impression_num], line index in behaviors.tsv
+        self.user_index = array.array('i')           # [impression_num], index in user_ID_dict (0 for <UNK>)
+        self.user_key = array.array('i')             # [impression_num], row of the user in the user history category tables (user_history_ID_dict)
+        self.history_offset = array.array('q')       # [impression_num]
+        self.history_length = array.array('i')       # [impression_num]
+        self.history_news = array.array('i')         # [history_news_num]
+        self.candidate_offsets = array.array('q', [0]) # [impression_num + 1], the candidates of impression i are [candidate_offsets[i], candidate_offsets[i + 1])
+        self.candidate_news = array.array('i')       # [candidate_num]
+        self.candidate_labels = array.array('b')     # [candidate_num]
+
+    def append(self, impression_ID: int, user_index: int, user_key: int, history: list, candidate_news: list, candidate_labels: list):
+        history = array.array('i', history)
+        history_span = self.user_history_span.get(user_key)
+        if history_span is None or self.history_news[history_span[0]: history_span[0] + history_span[1]] != history:
+            history_span = (len(self.history_news), len(history))
+            self.history_news.extend(history)
+            self.user_history_span[user_key] = history_span
+        self.impression_ID.append(impression_ID)
+        self.user_index.append(user_index)
+        self.user_key.append(user_key)
+        self.history_offset.append(history_span[0])
+        self.history_length.append(history_span[1])
+        self.candidate_news.extend(candidate_news)
+        self.candidate_labels.extend(candidate_labels)
+        self.candidate_offsets.append(len(self.candidate_news))
+
+    # Convert the appended columns to numpy arrays, no behavior can be appended afterwards
+    def build(self):
+        del self.user_history_span
+        self.impression_ID = np.array(self.impression_ID, dtype=np.int64)
+        self.user_index = np.array(self.user_index, dtype=np.int32)
+        self.user_key = np.array(self.user_key, dtype=np.int32)
+        self.history_offset = np.array(self.history_offset, dtype=np.int64)
+        self.history_length = np.array(self.history_length, dtype=np.int32)
+        self.history_news = np.array(self.history_news, dtype=np.int32)
+        self.candidate_offsets = np.array(self.candidate_offsets, dtype=np.int64)
+        self.candidate_news = np.array(self.candidate_news, dtype=np.int32)
+        self.candidate_labels = np.array(self.candidate_labels, dtype=np.int8)
+        self.impression_num = self.impression_ID.shape[0]
+        self.candidate_num = self.candidate_news.shape[0]
+        return self
+
+    # Move the built columns into shared memory (see share_memory)
+    def share_memory(self):
+        for name in MIND_Behaviors.columns:
+            setattr(self, name, share_memory(getattr(self, name)))
+        return self
+
+    def save(self, file: str):
+        np.savez(file, **{name: getattr(self, name) for name in MIND_Behaviors.columns})
+
+    # Load the built behaviors saved by save
+    @staticmethod
+    def load(file: str, max_history_num: int):
+        behaviors = MIND_Behaviors(max_history_num)
+        del behaviors.user_history_span
+        with np.load(file) as columns:
+            for name in MIND_Behaviors.columns:
+                setattr(behaviors, name, columns[name])
+        behaviors.impression_num = behaviors.impression_ID.shape[0]
+        behaviors.candidate_num = behaviors.candidate_news.shape[0]
+        return behaviors
+
+    # Save the built columns as .npy files of a directory
+    def save_columns(self, path: str):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in MIND_Behaviors.columns:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    # Load the built behaviors saved by save_columns
+    @staticmethod
+    def load_columns(path: str, max_history_num: int):
+        behaviors = MIND_Behaviors(max_history_num)
+        del behaviors.user_history_span
+        for name in MIND_Behaviors.columns:
+            setattr(behaviors, name, np.load(os.path.join(path, name + '.npy')))
+        behaviors.impression_num = behaviors.impression_ID.shape[0]
+        behaviors.candidate_num = behaviors.candidate_news.shape[0]
+        return behaviors
+
+    # Concatenate built behaviors into one, the history and candidate offsets are shifted to the concatenated flat arrays
+    @staticmethod
+    def concatenate(behaviors_list: list, max_history_num: int):
+        behaviors = MIND_Behaviors(max_history_num)
+        del behaviors.user_history_span
+        history_bases = np.cumsum([0] + [_behaviors.history_news.shape[0] for _behaviors in behaviors_list[:-1]])
+        candidate_bases = np.cumsum([0] + [_behaviors.candidate_num for _behaviors in behaviors_list[:-1]])
+        for name in ['impression_ID', 'user_index', 'user_key', 'history_length', 'history_news', 'candidate_news', 'candidate_labels']:
+            setattr(behaviors, name, np.concatenate([getattr(_behaviors, name) for _behaviors in behaviors_list]))
+        behaviors.history_offset = np.concatenate([_behaviors.history_offset + history_base for _behaviors, history_base in zip(behaviors_list, history_bases)])
+        behaviors.candidate_offsets = np.concatenate([np.zeros([1], dtype=np.int64)] + [_behaviors.candidate_offsets[1:] + candidate_base for _behaviors, candidate_base in zip(behaviors_list, candidate_bases)])
+        behaviors.impression_num = behaviors.impression_ID.shape[0]
+        behaviors.candidate_num = behaviors.candidate_news.shape[0]
+        return behaviors
+
+    # Impression index of each candidate
+    # Output
+    # candidate_impression : [candidate_num]
+    def candidate_impression(self):
+        return np.repeat(np.arange(self.impression_num), np.diff(self.candidate_offsets))
+
+    # Padded histories of impressions, e.g., [n1, n2, 0, 0] & [1, 1, 0, 0] for the history [n1, n2] and max_history_num = 4
+    # Output
+    # history_index : [len(impressions), max_history_num]
+    # history_mask  : [len(impressions), max_history_num]
+    def histories(self, impressions: np.ndarray):
+        history_mask = np.arange(self.max_history_num) < self.history_length[impressions, np.newaxis]                       # [len(impressions), max_history_num]
+        positions = self.history_offset[impressions, np.newaxis] + np.arange(self.max_history_num)                           # [len(impressions), max_history_num]
+        history_index = np.zeros(history_mask.shape, dtype=np.int32)
+        history_index[history_mask] = self.history_news[positions[history_mask]]
+        return history_index, history_mask.astype(np.float32)
+
+    # Distinct users of the impressions, i.e., (user key, history) pairs, numbered by their first appearance
+    # Output
+    # impression_user : [impression_num], user index of each impression
+    # user_impression : [user_num], first impression of each user
+    def users(self):
+        _, first_impressions, inverse = np.unique(self.user_key.astype(np.int64) * (self.history_news.shape[0] + 1) + self.history_offset, return_index=True, return_inverse=True)
+        order = np.argsort(first_impressions)
+        user_order = np.empty_like(order)
+        user_order[order] = np.arange(order.shape[0])
+        return user_order[inverse.reshape(-1)], first_impressions[order]
+
+
 class MIND_Corpus:
+    news_tables = ['news_category', 'news_subCategory', 'news_title_text', 'news_title_mask', 'news_title_entity', 'news_abstract_text', 'news_abstract_mask', 'news_abstract_entity']
+
     @staticmethod
     def preprocess(config: Config):
         user_ID_file = 'user_ID.json'
@@ -28,12 +279,12 @@ class MIND_Corpus:
         category_file = 'category.json'
         subCategory_file = 'subCategory.json'
         vocabulary_file = 'vocabulary-' + str(config.word_threshold) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '.json'
-        word_embedding_file = 'word_embedding-' + str(config.word_threshold) + '-' + str(config.word_embedding_dim) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '.pkl'
+        word_embedding_file = 'word_embedding-' + str(config.word_threshold) + '-' + str(config.word_embedding_dim) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '-' + config.word_embedding_source + '.pkl'
         entity_file = 'entity.json'
         entity_embedding_file = 'entity_embedding.pkl'
         context_embedding_file = 'context_embedding.pkl'
-        user_history_graph_file = 'user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '.pkl'
-        preprocessed_data_files = [user_ID_file, news_ID_file, category_file, subCategory_file, vocabulary_file, word_embedding_file, entity_file, entity_embedding_file, context_embedding_file, context_embedding_file, user_history_graph_file]
+        user_history_category_file = 'user_history_category-' + str(config.max_history_num) + '.pkl'
+        preprocessed_data_files = [user_ID_file, news_ID_file, category_file, subCategory_file, vocabulary_file, word_embedding_file, entity_file, entity_embedding_file, context_embedding_file, user_history_category_file]
 
         if not all(list(map(lambda x:os.path.exists(x), preprocessed_data_files))):
             user_ID_dict = {'<UNK>': 0}
@@ -43,10 +294,9 @@ class MIND_Corpus:
             word_dict = {'<PAD>': 0, '<UNK>': 1}
             word_counter = collections.Counter()
             entity_dict = {'<PAD>': 0, '<UNK>': 1}
-            user_history_graph = {}            # {user_ID: history_graph}
-            user_history_category_mask = {}    # {user_ID: history_category_mask}
-            user_history_category_indices = {} # {user_ID: history_category_indices}
+            user_history_ID_dict = {} # {user_ID: row in the user history category tables}
             news_category_dict = {}
+            tokenized_news = {} # {news_ID: (title_words, abstract_words)}, reused by the corpus build
 
             # 1. user ID dictionay
             with open(os.path.join(config.train_root, 'behaviors.tsv'), 'r', encoding='utf-8') as train_behaviors_f:
@@ -58,6 +308,7 @@ class MIND_Corpus:
                     json.dump(user_ID_dict, user_ID_f)
 
             # 2. news ID dictionay & news category dictionay & news subCategory dictionay
+            split_news = [[], [], []] # news first appearing in the train, dev and test sets, [(news_ID, title, abstract)]
             for i, prefix in enumerate([config.train_root, config.dev_root, config.test_root]):
                 with open(os.path.join(prefix, 'news.tsv'), 'r', encoding='utf-8') as train_news_f:
                     for line in train_news_f:
@@ -69,26 +320,7 @@ class MIND_Corpus:
                                     category_dict[category] = len(category_dict)
                                 if subCategory not in subCategory_dict:
                                     subCategory_dict[subCategory] = len(subCategory_dict)
-                            words = pat.findall(title.lower()) if config.tokenizer == 'MIND' else word_tokenize(title.lower())
-                            for word in words:
-                                if is_number(word):
-                                    word_counter['<NUM>'] += 1
-                                else:
-                                    if i == 0: # training set
-                                        word_counter[word] += 1
-                                    else:
-                                        if word in word_counter: # already appeared in training set
-                                            word_counter[word] += 1
-                            words = pat.findall(abstract.lower()) if config.tokenizer == 'MIND' else word_tokenize(abstract.lower())
-                            for word in words:
-                                if is_number(word):
-                                    word_counter['<NUM>'] += 1
-                                else:
-                                    if i == 0: # training set
-                                        word_counter[word] += 1
-                                    else:
-                                        if word in word_counter: # already appeared in training set
-                                            word_counter[word] += 1
+                            split_news[i].append((news_ID, title, abstract))
                             for entity in json.loads(title_entities):
                                 WikidataId = entity['WikidataId']
                                 if WikidataId not in entity_dict:
@@ -98,6 +330,16 @@ class MIND_Corpus:
                                 if WikidataId not in entity_dict:
                                     entity_dict[WikidataId] = len(entity_dict)
                         news_category_dict[news_ID] = category_dict[category]
+            # the news are tokenized in parallel, only the words appeared in the training set are counted in the dev and test sets
+            for i in range(3):
+                _tokenized_news, _word_counter = parallel_tokenize_news(split_news[i], config.tokenizer, config.tokenize_process_num)
+                tokenized_news.update(_tokenized_news)
+                if i == 0: # training set
+                    word_counter.update(_word_counter)
+                else:
+                    for word, count in _word_counter.items():
+                        if word == '<NUM>' or word in word_counter: # already appeared in training set
+                            word_counter[word] += count
             with open(news_ID_file, 'w', encoding='utf-8') as news_ID_f:
                 json.dump(news_ID_dict, news_ID_f)
             with open(category_file, 'w', encoding='utf-8') as category_f:
@@ -115,13 +357,19 @@ class MIND_Corpus:
                 json.dump(word_dict, vocabulary_f)
 
             # 4. Glove word embedding
-            if config.word_embedding_dim == 300:
-                glove = GloVe(name='840B', dim=300, cache='../glove', max_vectors=10000000000)
+            glove_name = '840B' if config.word_embedding_dim == 300 else '6B'
+            glove_file = os.path.join(config.glove_root, 'glove.' + glove_name + '.' + str(config.word_embedding_dim) + 'd.txt')
+            if config.random_word_embedding: # all words are initialized randomly with the seeded random number generator
+                glove_stoi = {}
+                glove_vectors = None
+                glove_mean_vector = torch.zeros([config.word_embedding_dim])
+            elif os.path.exists(glove_file): # streamed offline, only the vectors of the vocabulary words are kept
+                glove_stoi, glove_vectors, glove_mean_vector = load_glove(glove_file, config.word_embedding_dim, word_dict)
             else:
-                glove = GloVe(name='6B', dim=config.word_embedding_dim, cache='../glove', max_vectors=10000000000)
-            glove_stoi = glove.stoi
-            glove_vectors = glove.vectors
-            glove_mean_vector = torch.mean(glove_vectors, dim=0, keepdim=False)
+                glove = GloVe(name=glove_name, dim=config.word_embedding_dim, cache=config.glove_root, max_vectors=10000000000)
+                glove_stoi = glove.stoi
+                glove_vectors = glove.vectors
+                glove_mean_vector = torch.mean(glove_vectors, dim=0, keepdim=False)
             word_embedding_vectors = torch.zeros([len(word_dict), config.word_embedding_dim])
             for word in word_dict:
                 index = word_dict[word]
@@ -136,26 +384,8 @@ class MIND_Corpus:
                 pickle.dump(word_embedding_vectors, word_embedding_f)
 
             # 5. knowledge-graph entity dictionary & eneity embedding & context embedding
-            entity_embedding_vectors = torch.zeros([len(entity_dict), config.entity_embedding_dim])
-            context_embedding_vectors = torch.zeros([len(entity_dict), config.context_embedding_dim])
-            for prefix in [config.train_root, config.dev_root, config.test_root]:
-                with open(os.path.join(prefix, 'entity_embedding.vec'), 'r', encoding='utf-8') as train_entity_f:
-                    for line in train_entity_f:
-                        if len(line.strip()) > 0:
-                            terms = line.strip().split('\t')
-                            assert len(terms) == config.entity_embedding_dim + 1, 'entity embedding dim does not match'
-                            WikidataId = terms[0]
-                            if WikidataId in entity_dict:
-                                entity_embedding_vectors[entity_dict[WikidataId]] = torch.FloatTensor(list(map(float, terms[1:])))
-            for prefix in [config.train_root, config.dev_root, config.test_root]:
-                with open(os.path.join(prefix, 'context_embedding.vec'), 'r', encoding='utf-8') as train_context_f:
-                    for line in train_context_f:
-                        if len(line.strip()) > 0:
-                            terms = line.strip().split('\t')
-                            assert len(terms) == config.context_embedding_dim + 1, 'context embedding dim does not match'
-                            WikidataId = terms[0]
-                            if WikidataId in entity_dict:
-                                context_embedding_vectors[entity_dict[WikidataId]] = torch.FloatTensor(list(map(float, terms[1:])))
+            entity_embedding_vectors = load_entity_embedding([os.path.join(prefix, 'entity_embedding.vec') for prefix in [config.train_root, config.dev_root, config.test_root]], entity_dict, config.entity_embedding_dim, 'entity')
+            context_embedding_vectors = load_entity_embedding([os.path.join(prefix, 'context_embedding.vec') for prefix in [config.train_root, config.dev_root, config.test_root]], entity_dict, config.context_embedding_dim, 'context')
             with open(entity_file, 'w', encoding='utf-8') as entity_f:
                 json.dump(entity_dict, entity_f)
             with open(entity_embedding_file, 'wb') as entity_embedding_f:
@@ -163,61 +393,40 @@ class MIND_Corpus:
             with open(context_embedding_file, 'wb') as context_embedding_f:
                 pickle.dump(context_embedding_vectors, context_embedding_f)
 
-            # 6. user history graph
+            # 6. user history category clusters, from which the user history graphs of SUE are built in batch (see layers.HistoryGraph)
+            # the categories of the first max_history_num history news of each user are collected into flat arrays, which are scattered into the tables at once
             category_num = len(category_dict)
-            graph_size = config.max_history_num + category_num # graph size of |V_{n}|+|V_{p}|
+            history_category = array.array('q') # [history_category_num], categories of the history news of all users
+            history_length = array.array('q')   # [user_history_num]
             for prefix in [config.train_root, config.dev_root, config.test_root]:
                 with open(os.path.join(prefix, 'behaviors.tsv'), 'r', encoding='utf-8') as train_behaviors_f:
                     for line in train_behaviors_f:
                         impression_ID, user_ID, time, history, impressions = line.split('\t')
-                        if user_ID not in user_history_graph:
-                            if config.no_self_connection:
-                                history_graph = np.zeros([graph_size, graph_size], dtype=np.float32)
-                            else:
-                                history_graph = np.identity(graph_size, dtype=np.float32)
-                            history_category_mask = np.zeros(category_num + 1, dtype=np.float32) # extra one category index for padding news
-                            history_category_indices = np.full([config.max_history_num], category_num, dtype=np.int64)
-                            if len(history.strip()) > 0:
-                                history_news_ID = history.split(' ')
-                                history_news_num = min(len(history_news_ID), config.max_history_num)
-                                for i in range(history_news_num):
-                                    category_index = news_category_dict[history_news_ID[i]]
-                                    history_category_mask[category_index] = 1.0
-                                    history_category_indices[i] = category_index
-                                    history_graph[i, config.max_history_num + category_index] = 1 # edge of E_{p}^{1} in inter-cluster graph G2
-                                    history_graph[config.max_history_num + category_index, i] = 1 # edge of E_{p}^{1} in inter-cluster graph G2
-                                    for j in range(i + 1, history_news_num):
-                                        _category_index = news_category_dict[history_news_ID[j]]
-                                        if category_index == _category_index:
-                                            history_graph[i, j] = 1 # edge of E_{n} in intra-cluster graph G1
-                                            history_graph[j, i] = 1 # edge of E_{n} in intra-cluster graph G1
-                                        else:
-                                            history_graph[config.max_history_num + category_index, config.max_history_num + _category_index] = 1 # edge of E_{p}^{2} in inter-cluster graph G2
-                                            history_graph[config.max_history_num + _category_index, config.max_history_num + category_index] = 1 # edge of E_{p}^{2} in inter-cluster graph G2
-                                if not config.no_adjacent_normalization:
-                                    if config.gcn_normalization_type == 'asymmetric':
-                                        # Asymmetric adjacent matrix normalization: D^{-\frac{1}{2}}A
-                                        D_inv = np.zeros([graph_size, graph_size], dtype=np.float32)
-                                        np.fill_diagonal(D_inv, 1 / history_graph.sum(axis=1, keepdims=False))
-                                        history_graph = np.matmul(D_inv, history_graph)
-                                    else:
-                                        # Symmetric adjacent matrix normalization: D^{-\frac{1}{2}}AD^{-\frac{1}{2}}
-                                        D_inv_sqrt = np.zeros([graph_size, graph_size], dtype=np.float32)
-                                        np.fill_diagonal(D_inv_sqrt, np.sqrt(1 / history_graph.sum(axis=1, keepdims=False)))
-                                        history_graph = np.matmul(np.matmul(D_inv_sqrt, history_graph), D_inv_sqrt)
-                            user_history_graph[user_ID] = history_graph
-                            user_history_category_mask[user_ID] = history_category_mask
-                            user_history_category_indices[user_ID] = history_category_indices
-            with open(user_history_graph_file, 'wb') as user_history_graph_f:
+                        if user_ID not in user_history_ID_dict:
+                            history_news_ID = history.split(' ')[:config.max_history_num] if len(history.strip()) > 0 else []
+                            history_category.extend(news_category_dict[news_ID] for news_ID in history_news_ID)
+                            history_length.append(len(history_news_ID))
+                            user_history_ID_dict[user_ID] = len(user_history_ID_dict)
+            history_category = np.array(history_category, dtype=np.int64)
+            history_length = np.array(history_length, dtype=np.int64)
+            history_user = np.repeat(np.arange(history_length.shape[0]), history_length)                                                    # [history_category_num]
+            history_position = np.arange(history_category.shape[0]) - np.repeat(np.cumsum(history_length) - history_length, history_length) # [history_category_num]
+            user_history_category_mask = np.zeros([history_length.shape[0], category_num + 1], dtype=np.float32) # extra one category index for padding news
+            user_history_category_mask[history_user, history_category] = 1.0
+            user_history_category_indices = np.full([history_length.shape[0], config.max_history_num], category_num, dtype=np.int64)
+            user_history_category_indices[history_user, history_position] = history_category
+            with open(user_history_category_file, 'wb') as user_history_category_f:
                 pickle.dump({
-                    'user_history_graph': user_history_graph,
+                    'user_history_ID_dict': user_history_ID_dict,
                     'user_history_category_mask': user_history_category_mask,
                     'user_history_category_indices': user_history_category_indices
-                }, user_history_graph_f)
+                }, user_history_category_f)
+            return tokenized_news
+        return {}
 
     def __init__(self, config: Config):
         # preprocess data
-        MIND_Corpus.preprocess(config)
+        tokenized_news = MIND_Corpus.preprocess(config) # {news_ID: (title_words, abstract_words)} if the news are tokenized in preprocessing
         with open('user_ID.json', 'r', encoding='utf-8') as user_ID_f:
             self.user_ID_dict = json.load(user_ID_f)
             config.user_num = len(self.user_ID_dict)
@@ -236,17 +445,63 @@ class MIND_Corpus:
         with open('entity.json', 'r', encoding='utf-8') as entity_f:
             self.entity_dict = json.load(entity_f)
             config.entity_size = len(self.entity_dict)
-        with open('user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '.pkl', 'rb') as user_history_graph_f:
-            user_history_data = pickle.load(user_history_graph_f)
-            self.user_history_graph = user_history_data['user_history_graph']
-            self.user_history_category_mask = user_history_data['user_history_category_mask']
-            self.user_history_category_indices = user_history_data['user_history_category_indices']
+        with open('user_history_category-' + str(config.max_history_num) + '.pkl', 'rb') as user_history_category_f:
+            user_history_data = pickle.load(user_history_category_f)
+            self.user_history_ID_dict = user_history_data['user_history_ID_dict']                               # {user_ID: user_key}
+            self.user_history_category_mask = share_memory(user_history_data['user_history_category_mask'])     # [user_history_num, category_num + 1]
+            self.user_history_category_indices = share_memory(user_history_data['user_history_category_indices']) # [user_history_num, max_history_num]
 
         # meta data
         self.negative_sample_num = config.negative_sample_num                                           # negative sample number for training
         self.max_history_num = config.max_history_num                                                   # max history number for each training user
         self.max_title_length = config.max_title_length                                                 # max title length for each news text
         self.max_abstract_length = config.max_abstract_length                                           # max abstract length for each news text
+        # load the news tables and the behaviors from the binary corpus cache, which is built from the tsv files at the first run (see load_news_tables and load_behaviors)
+        self.load_news_tables(config, tokenized_news)
+        if config.train_stream: # the training behaviors are streamed from the shards on disk in out-of-core training (see write_train_shards)
+            self.train_shard_files, self.train_shard_sample_nums = self.write_train_shards(config)
+            self.train_behaviors = MIND_Behaviors(self.max_history_num).build()
+        else:
+            self.train_behaviors = self.load_behaviors(config, 'train', config.train_root) # impressions with click labels, a training sample per click
+        self.dev_behaviors = self.load_behaviors(config, 'dev', config.dev_root)               # impressions with candidate labels
+        if config.mode != 'predict':
+            self.test_behaviors = self.load_behaviors(config, 'test', config.test_root)        # impressions with candidate labels
+        else: # the test behaviors are streamed in predict mode (see stream_behaviors)
+            self.test_behaviors = MIND_Behaviors(self.max_history_num).build()
+        self.train_behaviors.share_memory()
+        self.dev_behaviors.share_memory()
+        self.test_behaviors.share_memory()
+        self.dev_indices = self.dev_behaviors.impression_ID[self.dev_behaviors.candidate_impression()]    # [dev_candidate_num], impression index for dev
+        self.dev_labels = self.dev_behaviors.candidate_labels.astype(np.float32)                         # [dev_candidate_num], click label for dev
+        self.test_indices = self.test_behaviors.impression_ID[self.test_behaviors.candidate_impression()] # [test_candidate_num], impression index for test
+        self.test_labels = self.test_behaviors.candidate_labels.astype(np.float32)                       # [test_candidate_num], click label for test
+
+    # Load the news tables from the .npy files of the corpus cache, the files are written once from the news.tsv files and keyed by the tokenization config in the directory name
+    # The tables are memory-mapped in out-of-core training, so that the memory of the DataLoader workers does not hold them, otherwise they are loaded into shared memory
+    def load_news_tables(self, config: Config, tokenized_news: dict):
+        news_table_path = 'news_tables-' + str(config.word_threshold) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length)
+        news_table_meta_file = os.path.join(news_table_path, 'news_tables.json')
+        news_table_meta = {'news_roots': [config.train_root, config.dev_root, config.test_root], 'news_num': self.news_num}
+        if not cache_exists(news_table_meta_file, news_table_meta):
+            self.build_news_tables(config, tokenized_news)
+            if not os.path.exists(news_table_path):
+                os.mkdir(news_table_path)
+            for name in MIND_Corpus.news_tables:
+                np.save(os.path.join(news_table_path, name + '.npy'), getattr(self, name))
+            news_table_meta['title_word_num'] = self.title_word_num
+            news_table_meta['abstract_word_num'] = self.abstract_word_num
+            with open(news_table_meta_file, 'w', encoding='utf-8') as news_table_meta_f: # written last, so that an interrupted run rebuilds the tables
+                json.dump(news_table_meta, news_table_meta_f)
+        with open(news_table_meta_file, 'r', encoding='utf-8') as news_table_meta_f:
+            news_table_meta = json.load(news_table_meta_f)
+            self.title_word_num = news_table_meta['title_word_num']
+            self.abstract_word_num = news_table_meta['abstract_word_num']
+        for name in MIND_Corpus.news_tables:
+            news_table_file = os.path.join(news_table_path, name + '.npy')
+            setattr(self, name, np.load(news_table_file, mmap_mode='r') if config.train_stream else share_memory(np.load(news_table_file)))
+
+    # Build the news tables from the titles and abstracts of the news.tsv files, the news not tokenized in preprocessing are tokenized here
+    def build_news_tables(self, config: Config, tokenized_news: dict):
         self.news_category = np.zeros([self.news_num], dtype=np.int32)                                  # [news_num]
         self.news_subCategory = np.zeros([self.news_num], dtype=np.int32)                               # [news_num]
         self.news_title_text = np.zeros([self.news_num, self.max_title_length], dtype=np.int32)         # [news_num, max_title_length]
@@ -255,11 +510,6 @@ class MIND_Corpus:
         self.news_abstract_text = np.zeros([self.news_num, self.max_abstract_length], dtype=np.int32)   # [news_num, max_abstract_length]
         self.news_abstract_mask = np.zeros([self.news_num, self.max_abstract_length], dtype=np.float32) # [news_num, max_abstract_length]
         self.news_abstract_entity = np.zeros([self.news_num, self.max_abstract_length], dtype=np.int32) # [news_num, max_abstract_length]
-        self.train_behaviors = []                                                                       # [user_ID, [history], [history_mask], click impression, [non-click impressions], history_graph_key]
-        self.dev_behaviors = []                                                                         # [user_ID, [history], [history_mask], history_graph_key, candidate_news_ID]
-        self.dev_indices = []                                                                           # index for dev
-        self.test_behaviors = []                                                                        # [user_ID, [history], [history_mask], history_graph_key, candidate_news_ID]
-        self.test_indices = []                                                                          # index for test
         self.title_word_num = 0
         self.abstract_word_num = 0
 
@@ -285,15 +535,22 @@ class MIND_Corpus:
                     news_lines.append(line)
                     news_ID_set.add(news_ID)
         assert self.news_num == len(news_ID_set), 'news num mismatch %d v.s. %d' % (self.news_num, len(news_ID_set))
+        untokenized_news = []
+        for line in news_lines:
+            news_ID, category, subCategory, title, abstract, _, title_entities, abstract_entities = line.split('\t')
+            if news_ID not in tokenized_news:
+                untokenized_news.append((news_ID, title, abstract))
+        if len(untokenized_news) > 0:
+            tokenized_news = {**tokenized_news, **parallel_tokenize_news(untokenized_news, config.tokenizer, config.tokenize_process_num)[0]}
         for line in news_lines:
             news_ID, category, subCategory, title, abstract, _, title_entities, abstract_entities = line.split('\t')
             index = self.news_ID_dict[news_ID]
             self.news_category[index] = self.category_dict[category] if category in self.category_dict else 0
             self.news_subCategory[index] = self.subCategory_dict[subCategory] if subCategory in self.subCategory_dict else 0
-            words = pat.findall(title.lower()) if config.tokenizer == 'MIND' else word_tokenize(title.lower())
+            title_words, abstract_words = tokenized_news[news_ID]
             offsets = [-1 for _ in range(len(title))]
             offset_index = 0
-            for i, word in enumerate(words):
+            for i, word in enumerate(title_words):
                 if i == self.max_title_length:
                     break
                 if is_number(word):
@@ -313,11 +570,10 @@ class MIND_Corpus:
                 for offset in entity['OccurrenceOffsets']:
                     if offsets[offset] != -1 and WikidataId in self.entity_dict:
                         self.news_title_entity[index][offsets[offset]] = self.entity_dict[WikidataId]
-            self.title_word_num += len(words)
-            words = pat.findall(abstract.lower()) if config.tokenizer == 'MIND' else word_tokenize(abstract.lower())
+            self.title_word_num += len(title_words)
             offsets = [-1 for _ in range(len(abstract))]
             offset_index = 0
-            for i, word in enumerate(words):
+            for i, word in enumerate(abstract_words):
                 if i == self.max_abstract_length:
                     break
                 if is_number(word):
@@ -337,61 +593,73 @@ class MIND_Corpus:
                 for offset in entity['OccurrenceOffsets']:
                     if offsets[offset] != -1 and WikidataId in self.entity_dict:
                         self.news_abstract_entity[index][offsets[offset]] = self.entity_dict[WikidataId]
-            self.abstract_word_num += len(words)
+            self.abstract_word_num += len(abstract_words)
         self.news_title_mask[0][0] = 1    # for <PAD> news
         self.news_abstract_mask[0][0] = 1 # for <PAD> news
 
-        # generate behavior meta data
-        with open(os.path.join(config.train_root, 'behaviors.tsv'), 'r', encoding='utf-8') as train_behaviors_f:
-            for line in train_behaviors_f:
-                impression_ID, user_ID, time, history, impressions = line.split('\t')
-                click_impressions = []
-                non_click_impressions = []
-                for impression in impressions.strip().split(' '):
-                    if impression[-2:] == '-1':
-                        click_impressions.append(self.news_ID_dict[impression[:-2]])
-                    else:
-                        non_click_impressions.append(self.news_ID_dict[impression[:-2]])
-                if len(history) != 0:
-                    history = list(map(lambda x: self.news_ID_dict[x], history.strip().split(' ')))
-                    padding_num = max(0, self.max_history_num - len(history))
-                    user_history = history[-self.max_history_num:] + [0] * padding_num
-                    user_history_mask = np.zeros([self.max_history_num], dtype=np.float32)
-                    user_history_mask[:min(len(history), self.max_history_num)] = 1.0
-                    for click_impression in click_impressions:
-                        self.train_behaviors.append([self.user_ID_dict[user_ID], user_history, user_history_mask, click_impression, non_click_impressions, user_ID])
-                else:
-                    for click_impression in click_impressions:
-                        self.train_behaviors.append([self.user_ID_dict[user_ID], [0 for _ in range(self.max_history_num)], np.zeros([self.max_history_num], dtype=np.float32), click_impression, non_click_impressions, user_ID])
-        with open(os.path.join(config.dev_root, 'behaviors.tsv'), 'r', encoding='utf-8') as dev_behaviors_f:
-            for dev_ID, line in enumerate(dev_behaviors_f):
-                impression_ID, user_ID, time, history, impressions = line.split('\t')
-                if len(history) != 0:
-                    history = list(map(lambda x: self.news_ID_dict[x], history.strip().split(' ')))
-                    padding_num = max(0, self.max_history_num - len(history))
-                    user_history = history[-self.max_history_num:] + [0] * padding_num
-                    user_history_mask = np.zeros([self.max_history_num], dtype=np.float32)
-                    user_history_mask[:min(len(history), self.max_history_num)] = 1.0
-                    for impression in impressions.strip().split(' '):
-                        self.dev_indices.append(dev_ID)
-                        self.dev_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, user_history, user_history_mask, user_ID, self.news_ID_dict[impression[:-2]]])
-                else:
-                    for impression in impressions.strip().split(' '):
-                        self.dev_indices.append(dev_ID)
-                        self.dev_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, [0 for _ in range(self.max_history_num)], np.zeros([self.max_history_num], dtype=np.float32), user_ID, self.news_ID_dict[impression[:-2]]])
-        with open(os.path.join(config.test_root, 'behaviors.tsv'), 'r', encoding='utf-8') as test_behaviors_f:
-            for test_ID, line in enumerate(test_behaviors_f):
-                impression_ID, user_ID, time, history, impressions = line.split('\t')
-                if len(history) != 0:
-                    history = list(map(lambda x: self.news_ID_dict[x], history.strip().split(' ')))
-                    padding_num = max(0, self.max_history_num - len(history))
-                    user_history = history[-self.max_history_num:] + [0] * padding_num
-                    user_history_mask = np.zeros([self.max_history_num], dtype=np.float32)
-                    user_history_mask[:min(len(history), self.max_history_num)] = 1.0
-                    for impression in impressions.strip().split(' '):
-                        self.test_indices.append(test_ID)
-                        self.test_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, user_history, user_history_mask, user_ID, self.news_ID_dict[impression[:-2]]])
-                else:
-                    for impression in impressions.strip().split(' '):
-                        self.test_indices.append(test_ID)
-                        self.test_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, [0 for _ in range(self.max_history_num)], np.zeros([self.max_history_num], dtype=np.float32), user_ID, self.news_ID_dict[impression[:-2]]])
+    # Load the behaviors of a split from the .npy columns of the corpus cache, the columns are written once from the behaviors.tsv file of the split
+    def load_behaviors(self, config: Config, split: str, root: str):
+        behaviors_path = os.path.join('behaviors-' + str(config.max_history_num), split)
+        behaviors_meta_file = os.path.join(behaviors_path, 'behaviors.json')
+        behaviors_meta = {'behaviors_root': root, 'news_num': self.news_num, 'user_num': len(self.user_ID_dict)}
+        if not cache_exists(behaviors_meta_file, behaviors_meta):
+            behaviors = MIND_Behaviors(self.max_history_num)
+            with open(os.path.join(root, 'behaviors.tsv'), 'r', encoding='utf-8') as behaviors_f:
+                for ID, line in enumerate(behaviors_f):
+                    self.parse_behavior(line, behaviors, ID)
+            behaviors.build().save_columns(behaviors_path)
+            with open(behaviors_meta_file, 'w', encoding='utf-8') as behaviors_meta_f: # written last, so that an interrupted run rebuilds the columns
+                json.dump(behaviors_meta, behaviors_meta_f)
+            return behaviors
+        return MIND_Behaviors.load_columns(behaviors_path, self.max_history_num)
+
+    # Parse a behavior line into an impression of behaviors, with the candidate news and their click labels
+    # The candidates of unlabeled behaviors (e.g., the test set of MIND-large) are labeled with 0
+    def parse_behavior(self, line: str, behaviors: MIND_Behaviors, impression_ID: int):
+        _, user_ID, time, history, impressions = line.split('\t')
+        history = list(map(lambda x: self.news_ID_dict[x], history.strip().split(' ')[-self.max_history_num:])) if len(history) != 0 else []
+        candidate_news = []
+        candidate_labels = []
+        for impression in impressions.strip().split(' '):
+            news_ID, _, label = impression.partition('-')
+            candidate_news.append(self.news_ID_dict[news_ID])
+            candidate_labels.append(int(label) if label != '' else 0)
+        behaviors.append(impression_ID, self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, self.user_history_ID_dict[user_ID], history, candidate_news, candidate_labels)
+
+    # Stream the behaviors of behaviors_file in chunks of at most impression_num impressions, each chunk is a MIND_Behaviors in the format of test_behaviors
+    def stream_behaviors(self, behaviors_file: str, impression_num: int):
+        behaviors = MIND_Behaviors(self.max_history_num)
+        with open(behaviors_file, 'r', encoding='utf-8') as behaviors_f:
+            for ID, line in enumerate(behaviors_f):
+                self.parse_behavior(line, behaviors, ID)
+                if ID % impression_num == impression_num - 1:
+                    yield behaviors.build()
+                    behaviors = MIND_Behaviors(self.max_history_num)
+        if len(behaviors.impression_ID) > 0:
+            yield behaviors.build()
+
+    # Write the training behaviors into shards of config.train_shard_impression_num impressions (saved MIND_Behaviors), which are written once and reused
+    # Output
+    # shard_files       : [shard_num]
+    # shard_sample_nums : [shard_num], training sample (click) number of each shard
+    def write_train_shards(self, config: Config):
+        shard_path = 'train_shards-' + str(config.max_history_num) + '-' + str(config.train_shard_impression_num)
+        shard_meta_file = os.path.join(shard_path, 'shards.json')
+        shard_meta = {'train_root': config.train_root, 'news_num': self.news_num, 'user_num': len(self.user_ID_dict)} # the shards hold news and user indices of the dictionaries
+        if not cache_exists(shard_meta_file, shard_meta):
+            if not os.path.exists(shard_path):
+                os.mkdir(shard_path)
+            shard_files = []
+            shard_sample_nums = []
+            for shard_index, behaviors in enumerate(self.stream_behaviors(os.path.join(config.train_root, 'behaviors.tsv'), config.train_shard_impression_num)):
+                shard_file = os.path.join(shard_path, 'shard-%05d.npz' % shard_index)
+                behaviors.save(shard_file)
+                shard_files.append(shard_file)
+                shard_sample_nums.append(int((behaviors.candidate_labels == 1).sum()))
+            shard_meta['shard_files'] = shard_files
+            shard_meta['shard_sample_nums'] = shard_sample_nums
+            with open(shard_meta_file, 'w', encoding='utf-8') as shard_meta_f: # written last, so that an interrupted run rewrites the shards
+                json.dump(shard_meta, shard_meta_f)
+        with open(shard_meta_file, 'r', encoding='utf-8') as shard_meta_f:
+            shard_meta = json.load(shard_meta_f)
+        return shard_meta['shard_files'], shard_meta['shard_sample_nums']
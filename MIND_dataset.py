@@ -1,17 +1,85 @@
-from MIND_corpus import MIND_Corpus
+from MIND_corpus import MIND_Corpus, MIND_Behaviors, share_memory
 import time
 import json
+import threading
 import pickle
-import platform
 from config import Config
 import torch
 import torch.utils.data as data
-from numpy.random import randint
+import numpy as np
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 
 
-class MIND_Train_Dataset(data.Dataset):
-    def __init__(self, corpus: MIND_Corpus):
+# Batch fetch path of the datasets (with news indices instead of news features in index-only mode, see Model.gather_news): indexed by a list of sample indices (e.g., sampled by a BatchSampler with batch_size=None in the DataLoader), a whole batch is gathered with one vectorized index per feature table,
+# into batch buffers that are reused across the batches of the main process (a batch is valid until the next batch is fetched) and allocated in shared memory in the DataLoader workers
+class MIND_Batch_Dataset(data.Dataset):
+    # The rows (samples) of the impressions of a user share the user history, they are stored once as a user row, row_impression is the impression index of each row
+    # The user rows are put in shared memory for the DataLoader workers, unless the dataset is built inside a worker (shared=False)
+    def prepare_user_rows(self, behaviors: MIND_Behaviors, row_impression: np.ndarray, shared: bool = True):
+        share = share_memory if shared else np.ascontiguousarray
+        impression_user_row, user_row_impression = behaviors.users()                                                    # [impression_num], [user_row_num]
+        self.user_row_index = share(impression_user_row[row_impression])                                                # [num]
+        self.user_row_ID = share(behaviors.user_index[user_row_impression].astype(np.int64))                            # [user_row_num]
+        user_row_history_index, user_row_history_mask = behaviors.histories(user_row_impression)                        # [user_row_num, max_history_num]
+        self.user_row_history_index = share(user_row_history_index)
+        self.user_row_history_mask = share(user_row_history_mask)
+        self.user_row_key = share(behaviors.user_key[user_row_impression])                                             # [user_row_num], row in the user history category tables
+        self.batch_buffers = {}
+
+    # user features of a row for the per-sample path of __getitem__
+    def user_sample(self, index: int):
+        user_row = self.user_row_index[index]
+        history_index = self.user_row_history_index[user_row]
+        user_key = self.user_row_key[user_row]
+        return self.user_row_ID[user_row], self.news_category[history_index], self.news_subCategory[history_index], self.news_title_text[history_index], self.news_title_mask[history_index], self.news_title_entity[history_index], self.news_abstract_text[history_index], self.news_abstract_mask[history_index], self.news_abstract_entity[history_index], \
+               self.user_row_history_mask[user_row], self.user_history_category_mask[user_key], self.user_history_category_indices[user_key]
+
+    def batch_buffer(self, name: str, shape: tuple, dtype: np.dtype):
+        dtype = torch.from_numpy(np.empty([0], dtype=dtype)).dtype
+        if data.get_worker_info() is not None:
+            return torch.empty(shape, dtype=dtype).share_memory_() # sent to the main process without copy, and not reused as the main process may still hold it
+        if threading.current_thread() is not threading.main_thread():
+            return torch.empty(shape, dtype=dtype) # not reused when the batches are fetched ahead by a background thread (see util.Prefetcher)
+        buffer = self.batch_buffers.get(name)
+        if buffer is None or tuple(buffer.shape) != shape:
+            buffer = torch.empty(shape, dtype=dtype)
+            self.batch_buffers[name] = buffer
+        return buffer
+
+    def gather(self, name: str, table: np.ndarray, index: np.ndarray):
+        buffer = self.batch_buffer(name, index.shape + table.shape[1:], table.dtype)
+        np.take(table, index, axis=0, out=buffer.numpy())
+        return buffer
+
+    # user features of the samples in the order of __getitem__, in the index-only batches the news features of the user history are replaced by the history news indices
+    def gather_users(self, indices: np.ndarray):
+        user_row_index = self.user_row_index[indices]                                                                   # [batch_size]
+        user_key = self.user_row_key[user_row_index]                                                                    # [batch_size]
+        return [self.gather('user_ID', self.user_row_ID, user_row_index)] + self.gather_news(self.user_row_history_index, user_row_index, 'user_') + \
+               [self.gather('user_history_mask', self.user_row_history_mask, user_row_index), self.gather('user_history_category_mask', self.user_history_category_mask, user_key), self.gather('user_history_category_indices', self.user_history_category_indices, user_key)]
+
+    # news features of news_index_table[indices], in the index-only batches the news indices only
+    def gather_news(self, news_index_table: np.ndarray, indices: np.ndarray, prefix: str):
+        if self.index_only:
+            return [self.gather(prefix + 'index', news_index_table, indices)]
+        news_index = news_index_table[indices]
+        return [self.gather(prefix + 'category', self.news_category, news_index), self.gather(prefix + 'subCategory', self.news_subCategory, news_index), \
+                self.gather(prefix + 'title_text', self.news_title_text, news_index), self.gather(prefix + 'title_mask', self.news_title_mask, news_index), self.gather(prefix + 'title_entity', self.news_title_entity, news_index), \
+                self.gather(prefix + 'abstract_text', self.news_abstract_text, news_index), self.gather(prefix + 'abstract_mask', self.news_abstract_mask, news_index), self.gather(prefix + 'abstract_entity', self.news_abstract_entity, news_index)]
+
+
+# Seed the negative sampling RNG stream of a DataLoader worker, the streams are reproducible under --seed and persist across epochs with persistent workers
+def init_train_worker(worker_id: int):
+    dataset = data.get_worker_info().dataset
+    dataset.negative_rng = np.random.default_rng([dataset.seed, worker_id + 1])
+
+
+class MIND_Train_Dataset(MIND_Batch_Dataset):
+    def __init__(self, corpus: MIND_Corpus, index_only: bool = False, seed: int = 0, behaviors: MIND_Behaviors = None, shared: bool = True):
+        self.index_only = index_only
+        self.seed = seed
+        self.negative_rng = np.random.default_rng([seed, 0]) # RNG stream of the main process, replaced in the DataLoader workers by init_train_worker
         self.negative_sample_num = corpus.negative_sample_num
         self.news_category = corpus.news_category
         self.news_subCategory = corpus.news_subCategory
@@ -21,32 +89,54 @@ class MIND_Train_Dataset(data.Dataset):
         self.news_abstract_text =  corpus.news_abstract_text
         self.news_abstract_mask = corpus.news_abstract_mask
         self.news_abstract_entity = corpus.news_abstract_entity
-        self.user_history_graph = corpus.user_history_graph
         self.user_history_category_mask = corpus.user_history_category_mask
         self.user_history_category_indices = corpus.user_history_category_indices
-        self.train_behaviors = corpus.train_behaviors
-        self.train_samples = [[0 for _ in range(1 + self.negative_sample_num)] for __ in range(len(self.train_behaviors))]
-        self.num = len(self.train_behaviors)
+        # a training sample per click of the training impressions, the behaviors can be given explicitly, e.g., the shuffle buffer of MIND_Train_Stream_Dataset, which is built in a DataLoader worker and not shared
+        behaviors = behaviors if behaviors is not None else corpus.train_behaviors
+        candidate_impression = behaviors.candidate_impression()                                                            # [candidate_num]
+        clicks = np.flatnonzero(behaviors.candidate_labels == 1)
+        row_impression = candidate_impression[clicks]                                                                      # [num]
+        self.num = clicks.shape[0]
+        self.train_samples = None # sampled by negative_sampling for the per-sample path
+        self.prepare_user_rows(behaviors, row_impression, shared)
+        share = share_memory if shared else np.ascontiguousarray
+        # the non-click news of the impressions are stored in CSR format, the rows of an impression share their segment
+        self.click_news = share(behaviors.candidate_news[clicks])                                                          # [num]
+        non_clicks = behaviors.candidate_labels != 1
+        self.negative_news = share(behaviors.candidate_news[non_clicks])                                                   # [negative_num]
+        segment_lengths = np.bincount(candidate_impression[non_clicks], minlength=behaviors.impression_num)                # [impression_num]
+        self.negative_offsets = share((np.cumsum(segment_lengths) - segment_lengths)[row_impression])                      # [num]
+        self.negative_lengths = share(segment_lengths[row_impression])                                                     # [num]
 
+    # Sample negative_sample_num non-click news for the training behaviors of indices, all rows at once
+    # Output
+    # news_index : [len(indices), 1 + negative_sample_num], the click news followed by the sampled non-click news
+    def sample_news(self, indices: np.ndarray):
+        K = self.negative_sample_num
+        negative_offsets = self.negative_offsets[indices]                                                                  # [len(indices)]
+        negative_lengths = self.negative_lengths[indices]                                                                  # [len(indices)]
+        news_index = np.zeros([indices.shape[0], 1 + K], dtype=np.int32)                                                   # [len(indices), 1 + K]
+        news_index[:, 0] = self.click_news[indices]
+        # rows with no more than K non-click news take them cyclically, e.g., [a, b, a, b] for [a, b] and K = 4, the rows without non-click news take <PAD> news
+        rows = np.flatnonzero((negative_lengths > 0) & (negative_lengths <= K))
+        news_index[rows, 1:] = self.negative_news[negative_offsets[rows, np.newaxis] + np.arange(K) % negative_lengths[rows, np.newaxis]]
+        # other rows draw K distinct non-click news uniformly in order, a draw colliding with the previous draws of its row is redrawn as in rejection sampling
+        rows = np.flatnonzero(negative_lengths > K)
+        lengths = negative_lengths[rows]                                                                                   # [row_num]
+        draws = np.zeros([rows.shape[0], K], dtype=np.int64)                                                               # [row_num, K]
+        for j in range(K):
+            pending = np.arange(rows.shape[0])
+            while pending.shape[0] > 0:
+                draws[pending, j] = self.negative_rng.integers(0, lengths[pending])
+                pending = pending[(draws[pending, :j] == draws[pending, j: j+1]).any(axis=1)]
+        news_index[rows, 1:] = self.negative_news[negative_offsets[rows, np.newaxis] + draws]
+        return news_index
+
+    # Sample the negative news of all training behaviors for the per-sample path of __getitem__, the batch path samples on the fly
     def negative_sampling(self):
         print('\nBegin negative sampling, training sample num : %d' % self.num)
         start_time = time.time()
-        for i, train_behavior in enumerate(self.train_behaviors):
-            self.train_samples[i][0] = train_behavior[3]
-            negative_samples = train_behavior[4]
-            news_num = len(negative_samples)
-            if news_num <= self.negative_sample_num:
-                for j in range(self.negative_sample_num):
-                    self.train_samples[i][j + 1] = negative_samples[j % news_num]
-            else:
-                used_negative_samples = set()
-                for j in range(self.negative_sample_num):
-                    while True:
-                        k = randint(0, news_num)
-                        if k not in used_negative_samples:
-                            self.train_samples[i][j + 1] = negative_samples[k]
-                            used_negative_samples.add(k)
-                            break
+        self.train_samples = self.sample_news(np.arange(self.num))
         end_time = time.time()
         print('End negative sampling, used time : %.3fs' % (end_time - start_time))
 
@@ -60,7 +150,6 @@ class MIND_Train_Dataset(data.Dataset):
     # user_abstract_mask            : [max_history_num, max_abstract_length]
     # user_abstract_entity          : [max_history_num, max_abstract_length]
     # user_history_mask             : [max_history_num]
-    # user_history_graph            : [max_history_num, max_history_num]
     # user_history_category_mask    : [category_num + 1]
     # user_history_category_indices : [max_history_num]
     # news_category                 : [1 + negative_sample_num]
@@ -72,19 +161,89 @@ class MIND_Train_Dataset(data.Dataset):
     # news_abstract_mask            : [1 + negative_sample_num, max_abstract_length]
     # news_abstract_entity          : [1 + negative_sample_num, max_abstract_length]
     def __getitem__(self, index):
-        train_behavior = self.train_behaviors[index]
-        history_index = train_behavior[1]
+        if isinstance(index, list):
+            indices = np.array(index, dtype=np.int64)
+            return self.gather_users(indices) + self.gather_news(self.sample_news(indices), np.arange(indices.shape[0]), 'news_')
         sample_index = self.train_samples[index]
-        user_key = train_behavior[5]
-        return train_behavior[0], self.news_category[history_index], self.news_subCategory[history_index], self.news_title_text[history_index], self.news_title_mask[history_index], self.news_title_entity[history_index], self.news_abstract_text[history_index], self.news_abstract_mask[history_index], self.news_abstract_entity[history_index], train_behavior[2], self.user_history_graph[user_key], self.user_history_category_mask[user_key], self.user_history_category_indices[user_key], \
-               self.news_category[sample_index], self.news_subCategory[sample_index], self.news_title_text[sample_index], self.news_title_mask[sample_index], self.news_title_entity[sample_index], self.news_abstract_text[sample_index], self.news_abstract_mask[sample_index], self.news_abstract_entity[sample_index]
+        return self.user_sample(index) + \
+              (self.news_category[sample_index], self.news_subCategory[sample_index], self.news_title_text[sample_index], self.news_title_mask[sample_index], self.news_title_entity[sample_index], self.news_abstract_text[sample_index], self.news_abstract_mask[sample_index], self.news_abstract_entity[sample_index])
 
     def __len__(self):
         return self.num
 
 
-class MIND_DevTest_Dataset(data.Dataset):
-    def __init__(self, corpus: MIND_Corpus, mode: str):
+# Out-of-core training dataset, the training behaviors are streamed from the shards written by MIND_Corpus.write_train_shards and yielded in batches
+# In each epoch the samples are ordered by a random order of the shards, and split into equal contiguous ranges, one per (rank, DataLoader worker) reader, the remainder samples are dropped so that all the readers yield the same number of batches
+# A reader shuffles its range with a bounded buffer: the range is served in buffers of shuffle_buffer_size samples (rounded to whole batches), the shards overlapping a buffer are loaded and the samples of the buffer are served in random order
+class MIND_Train_Stream_Dataset(data.IterableDataset):
+    def __init__(self, corpus: MIND_Corpus, config: Config, index_only: bool = False):
+        self.index_only = index_only
+        self.seed = config.seed
+        self.epoch = 0
+        self.batch_size = config.batch_size
+        self.buffer_sample_num = max(config.shuffle_buffer_size // config.batch_size, 1) * config.batch_size
+        self.num_workers = config.num_workers
+        self.max_history_num = corpus.max_history_num
+        self.shard_files = corpus.train_shard_files
+        self.shard_sample_nums = np.array(corpus.train_shard_sample_nums, dtype=np.int64)
+        self.num = int(self.shard_sample_nums.sum())
+        # the corpus tables read by MIND_Train_Dataset, the dataset stands in for the corpus so that the workers do not hold the corpus dictionaries
+        self.negative_sample_num = corpus.negative_sample_num
+        self.news_category = corpus.news_category
+        self.news_subCategory = corpus.news_subCategory
+        self.news_title_text =  corpus.news_title_text
+        self.news_title_mask = corpus.news_title_mask
+        self.news_title_entity = corpus.news_title_entity
+        self.news_abstract_text =  corpus.news_abstract_text
+        self.news_abstract_mask = corpus.news_abstract_mask
+        self.news_abstract_entity = corpus.news_abstract_entity
+        self.user_history_category_mask = corpus.user_history_category_mask
+        self.user_history_category_indices = corpus.user_history_category_indices
+
+    # Rank of this process and the number of ranks
+    def rank(self):
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    # Index of this process among all the (rank, worker) readers of the shards, and the reader number
+    def reader(self):
+        rank, world_size = self.rank()
+        worker_info = data.get_worker_info()
+        worker_id, worker_num = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return rank * worker_num + worker_id, world_size * worker_num
+
+    # Each pass is an epoch, with persistent workers the epoch counter of each worker advances with the epochs
+    def __iter__(self):
+        reader_index, reader_num = self.reader()
+        rng = np.random.default_rng([self.seed, reader_index + 1, self.epoch]) # sample order & negative sampling of this reader
+        shard_order = np.random.default_rng([self.seed, 0, self.epoch]).permutation(len(self.shard_files)) # shared by all readers
+        self.epoch += 1
+        shard_ends = np.cumsum(self.shard_sample_nums[shard_order])            # [shard_num], end of the samples of each shard in the sample order of the epoch
+        sample_num = self.num // reader_num
+        shards, shard_range, dataset = {}, None, None                          # the shards and the dataset of the last buffer, keyed by their position in shard_order
+        for start in range(reader_index * sample_num, (reader_index + 1) * sample_num, self.buffer_sample_num):
+            end = min(start + self.buffer_sample_num, (reader_index + 1) * sample_num)
+            first, last = np.searchsorted(shard_ends, [start, end - 1], side='right').tolist() # the shards overlapping the buffer
+            if shard_range != (first, last):
+                shards = {k: shards[k] if k in shards else MIND_Behaviors.load(self.shard_files[shard_order[k]], self.max_history_num) for k in range(first, last + 1)}
+                dataset = MIND_Train_Dataset(self, self.index_only, self.seed, MIND_Behaviors.concatenate([shards[k] for k in range(first, last + 1)], self.max_history_num), shared=False)
+                dataset.negative_rng = rng
+                shard_range = (first, last)
+            order = rng.permutation(end - start) + (start - (shard_ends[first] - self.shard_sample_nums[shard_order[first]])) # the buffer samples in the dataset
+            for i in range(0, end - start, self.batch_size):
+                yield dataset[order[i: i+self.batch_size].tolist()]
+
+    # Number of batches of an epoch on this rank, the same on all ranks
+    def __len__(self):
+        worker_num = max(self.num_workers, 1)
+        sample_num = self.num // (self.rank()[1] * worker_num)
+        return worker_num * ((sample_num + self.batch_size - 1) // self.batch_size)
+
+
+class MIND_DevTest_Dataset(MIND_Batch_Dataset):
+    def __init__(self, corpus: MIND_Corpus, mode: str, behaviors: MIND_Behaviors = None, index_only: bool = False):
+        self.index_only = index_only
         assert mode in ['dev', 'test'], 'mode must be choosen from \'dev\' or \'test\''
         self.news_category = corpus.news_category
         self.news_subCategory = corpus.news_subCategory
@@ -94,11 +253,13 @@ class MIND_DevTest_Dataset(data.Dataset):
         self.news_abstract_text =  corpus.news_abstract_text
         self.news_abstract_mask = corpus.news_abstract_mask
         self.news_abstract_entity = corpus.news_abstract_entity
-        self.user_history_graph = corpus.user_history_graph
         self.user_history_category_mask = corpus.user_history_category_mask
         self.user_history_category_indices = corpus.user_history_category_indices
-        self.behaviors = (corpus.dev_behaviors if mode == 'dev' else corpus.test_behaviors)
-        self.num = len(self.behaviors)
+        # the behaviors can be given explicitly, e.g., a chunk of streamed test behaviors (see MIND_Corpus.stream_behaviors)
+        self.behaviors = behaviors if behaviors is not None else (corpus.dev_behaviors if mode == 'dev' else corpus.test_behaviors)
+        self.num = self.behaviors.candidate_num
+        self.candidate_news_index = self.behaviors.candidate_news                                                       # [num]
+        self.prepare_user_rows(self.behaviors, self.behaviors.candidate_impression())
 
     # user_ID                        : [1]
     # user_category                  : [max_history_num]
@@ -110,7 +271,6 @@ class MIND_DevTest_Dataset(data.Dataset):
     # user_abstract_mask             : [max_history_num, max_abstract_length]
     # user_abstract_entity           : [max_history_num, max_abstract_length]
     # user_history_mask              : [max_history_num]
-    # user_history_graph             : [max_history_num, max_history_num]
     # user_history_category_mask     : [category_num + 1]
     # user_history_category_indices  : [max_history_num]
     # candidate_news_category        : [1]
@@ -122,17 +282,157 @@ class MIND_DevTest_Dataset(data.Dataset):
     # candidate_news_abstract_mask   : [max_abstract_length]
     # candidate_news_abstract_entity : [max_abstract_length]
     def __getitem__(self, index):
-        behavior = self.behaviors[index]
-        history_index = behavior[1]
-        user_key = behavior[3]
-        candidate_news_index = behavior[4]
-        return behavior[0], self.news_category[history_index], self.news_subCategory[history_index], self.news_title_text[history_index], self.news_title_mask[history_index], self.news_title_entity[history_index], self.news_abstract_text[history_index], self.news_abstract_mask[history_index], self.news_abstract_entity[history_index], behavior[2], self.user_history_graph[user_key], self.user_history_category_mask[user_key], self.user_history_category_indices[user_key], \
-               self.news_category[candidate_news_index], self.news_subCategory[candidate_news_index], self.news_title_text[candidate_news_index], self.news_title_mask[candidate_news_index], self.news_title_entity[candidate_news_index], self.news_abstract_text[candidate_news_index], self.news_abstract_mask[candidate_news_index], self.news_abstract_entity[candidate_news_index]
+        if isinstance(index, list):
+            indices = np.array(index, dtype=np.int64)
+            return self.gather_users(indices) + self.gather_news(self.candidate_news_index, indices, 'news_')
+        candidate_news_index = self.candidate_news_index[index]
+        return self.user_sample(index) + \
+              (self.news_category[candidate_news_index], self.news_subCategory[candidate_news_index], self.news_title_text[candidate_news_index], self.news_title_mask[candidate_news_index], self.news_title_entity[candidate_news_index], self.news_abstract_text[candidate_news_index], self.news_abstract_mask[candidate_news_index], self.news_abstract_entity[candidate_news_index])
+
+    def __len__(self):
+        return self.num
+
+
+class MIND_DevTest_Impression_Dataset(data.Dataset):
+    def __init__(self, corpus: MIND_Corpus, mode: str, behaviors: MIND_Behaviors = None):
+        assert mode in ['dev', 'test'], 'mode must be choosen from \'dev\' or \'test\''
+        self.news_category = corpus.news_category
+        self.news_subCategory = corpus.news_subCategory
+        self.news_title_text =  corpus.news_title_text
+        self.news_title_mask = corpus.news_title_mask
+        self.news_title_entity = corpus.news_title_entity
+        self.news_abstract_text =  corpus.news_abstract_text
+        self.news_abstract_mask = corpus.news_abstract_mask
+        self.news_abstract_entity = corpus.news_abstract_entity
+        self.user_history_category_mask = corpus.user_history_category_mask
+        self.user_history_category_indices = corpus.user_history_category_indices
+        # the behaviors can be given explicitly, e.g., a chunk of streamed test behaviors (see MIND_Corpus.stream_behaviors)
+        self.behaviors = behaviors if behaviors is not None else (corpus.dev_behaviors if mode == 'dev' else corpus.test_behaviors)
+        # each impression is a candidate range [offsets[i], offsets[i + 1])
+        self.offsets = self.behaviors.candidate_offsets
+        self.num = self.behaviors.impression_num
+        # impressions with the same user key (user_ID, history) share one user encoding, they are served contiguously and batched together (see user_grouped_batches)
+        self.user_indices, user_impression = self.behaviors.users()                                                                         # [impression_num]
+        self.user_num = user_impression.shape[0]
+        self.order = np.argsort(self.user_indices, kind='stable')                                                                            # [impression_num]
+        # flat positions of the candidates in serving order, to put the scores back in the order of behaviors
+        offsets = self.offsets
+        lengths = np.diff(offsets)[self.order]
+        self.candidate_positions = np.repeat(offsets[:-1][self.order] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum()) # [candidate_num]
+
+    # user_ID, padded history & user key of an impression
+    def impression_user(self, index: int):
+        history_index, history_mask = self.behaviors.histories(np.array([index]))
+        return int(self.behaviors.user_index[index]), history_index[0], history_mask[0], self.behaviors.user_key[index]
+
+    # Batches of at most batch_size impressions in serving order, the impressions of a user are kept in one batch unless they exceed batch_size
+    def user_grouped_batches(self, batch_size: int):
+        group_ends = np.append(np.flatnonzero(np.diff(self.user_indices[self.order])) + 1, self.num).tolist()
+        batches = []
+        batch_start = 0
+        group_start = 0
+        for group_end in group_ends:
+            if group_end - batch_start > batch_size and group_start > batch_start:
+                batches.append(list(range(batch_start, group_start)))
+                batch_start = group_start
+            while group_end - batch_start > batch_size:
+                batches.append(list(range(batch_start, batch_start + batch_size)))
+                batch_start += batch_size
+            group_start = group_end
+        if batch_start < self.num:
+            batches.append(list(range(batch_start, self.num)))
+        return batches
+
+    # user_index                     : [1] (index of the user key)
+    # user_ID                        : [1]
+    # user_category                  : [max_history_num]
+    # user_subCategory               : [max_history_num]
+    # user_title_text                : [max_history_num, max_title_length]
+    # user_title_mask                : [max_history_num, max_title_length]
+    # user_title_entity              : [max_history_num, max_title_length]
+    # user_abstract_text             : [max_history_num, max_abstract_length]
+    # user_abstract_mask             : [max_history_num, max_abstract_length]
+    # user_abstract_entity           : [max_history_num, max_abstract_length]
+    # user_history_mask              : [max_history_num]
+    # user_history_category_mask     : [category_num + 1]
+    # user_history_category_indices  : [max_history_num]
+    # candidate_news_index           : [candidate_num]
+    def __getitem__(self, index):
+        index = self.order[index]
+        user_ID, history_index, history_mask, user_key = self.impression_user(index)
+        candidate_news_index = self.behaviors.candidate_news[self.offsets[index]: self.offsets[index + 1]].astype(np.int64)
+        return self.user_indices[index], user_ID, self.news_category[history_index], self.news_subCategory[history_index], self.news_title_text[history_index], self.news_title_mask[history_index], self.news_title_entity[history_index], self.news_abstract_text[history_index], self.news_abstract_mask[history_index], self.news_abstract_entity[history_index], history_mask, self.user_history_category_mask[user_key], self.user_history_category_indices[user_key], \
+               candidate_news_index
+
+    # The user features are collated for the distinct users of the batch only, user_index maps each impression to its user
+    # user_index                     : [batch_size]
+    # Candidates of the impressions in a batch are padded with the <PAD> news to the largest candidate number of the batch
+    # candidate_news_mask            : [batch_size, candidate_num]
+    # candidate_news_category        : [batch_size, candidate_num]
+    # candidate_news_subCategory     : [batch_size, candidate_num]
+    # candidate_news_title_text      : [batch_size, candidate_num, max_title_length]
+    # candidate_news_title_mask      : [batch_size, candidate_num, max_title_length]
+    # candidate_news_title_entity    : [batch_size, candidate_num, max_title_length]
+    # candidate_news_abstract_text   : [batch_size, candidate_num, max_abstract_length]
+    # candidate_news_abstract_mask   : [batch_size, candidate_num, max_abstract_length]
+    # candidate_news_abstract_entity : [batch_size, candidate_num, max_abstract_length]
+    def collate(self, samples):
+        user_samples, user_index = self.deduplicate_users(samples)
+        candidate_news_mask, candidate_news_index = self.pad_candidates(samples)
+        return tuple(default_collate([sample[1:-1] for sample in user_samples])) + (torch.from_numpy(user_index), ) + \
+               (torch.from_numpy(candidate_news_mask), torch.from_numpy(self.news_category[candidate_news_index]), torch.from_numpy(self.news_subCategory[candidate_news_index]), torch.from_numpy(self.news_title_text[candidate_news_index]), torch.from_numpy(self.news_title_mask[candidate_news_index]), torch.from_numpy(self.news_title_entity[candidate_news_index]), \
+                torch.from_numpy(self.news_abstract_text[candidate_news_index]), torch.from_numpy(self.news_abstract_mask[candidate_news_index]), torch.from_numpy(self.news_abstract_entity[candidate_news_index]))
+
+    # samples of the same user are contiguous in serving order
+    def deduplicate_users(self, samples):
+        user_samples = [samples[0]]
+        user_index = np.zeros([len(samples)], dtype=np.int64)
+        for i in range(1, len(samples)):
+            if samples[i][0] != samples[i - 1][0]:
+                user_samples.append(samples[i])
+            user_index[i] = len(user_samples) - 1
+        return user_samples, user_index
+
+    def pad_candidates(self, samples):
+        candidate_num = max(len(sample[-1]) for sample in samples)
+        candidate_news_index = np.zeros([len(samples), candidate_num], dtype=np.int64)
+        candidate_news_mask = np.zeros([len(samples), candidate_num], dtype=bool)
+        for i, sample in enumerate(samples):
+            candidate_news_index[i, :len(sample[-1])] = sample[-1]
+            candidate_news_mask[i, :len(sample[-1])] = True
+        return candidate_news_mask, candidate_news_index
 
     def __len__(self):
         return self.num
 
 
+class MIND_DevTest_Catalog_Dataset(MIND_DevTest_Impression_Dataset):
+    def __init__(self, corpus: MIND_Corpus, mode: str, behaviors: MIND_Behaviors = None):
+        super(MIND_DevTest_Catalog_Dataset, self).__init__(corpus, mode, behaviors)
+
+    # News are represented by their indices into the precomputed news representation table
+    # user_index                     : [1] (index of the user key)
+    # user_ID                        : [1]
+    # user_history_index             : [max_history_num]
+    # user_history_mask              : [max_history_num]
+    # user_history_category_mask     : [category_num + 1]
+    # user_history_category_indices  : [max_history_num]
+    # candidate_news_index           : [candidate_num]
+    def __getitem__(self, index):
+        index = self.order[index]
+        user_ID, history_index, history_mask, user_key = self.impression_user(index)
+        candidate_news_index = self.behaviors.candidate_news[self.offsets[index]: self.offsets[index + 1]].astype(np.int64)
+        return self.user_indices[index], user_ID, history_index.astype(np.int64), history_mask, self.user_history_category_mask[user_key], self.user_history_category_indices[user_key], candidate_news_index
+
+    # user_index                     : [batch_size]
+    # candidate_news_mask            : [batch_size, candidate_num]
+    # candidate_news_index           : [batch_size, candidate_num]
+    def collate(self, samples):
+        user_samples, user_index = self.deduplicate_users(samples)
+        candidate_news_mask, candidate_news_index = self.pad_candidates(samples)
+        return tuple(default_collate([sample[1:-1] for sample in user_samples])) + (torch.from_numpy(user_index), torch.from_numpy(candidate_news_mask), torch.from_numpy(candidate_news_index))
+
+
 if __name__ == '__main__':
     start_time = time.time()
     config = Config()
@@ -148,8 +448,8 @@ if __name__ == '__main__':
     end_time = time.time()
     print('load time : %.3fs' % (end_time - start_time))
     print('MIND_Train_Dataset :', len(mind_train_dataset))
-    train_dataloader = DataLoader(mind_train_dataset, batch_size=config.batch_size, shuffle=True, num_workers=config.batch_size // 8 if platform.system() == 'Linux' else 0)
-    for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+    train_dataloader = DataLoader(mind_train_dataset, batch_size=config.batch_size, shuffle=True, num_workers=config.num_workers)
+    for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
          news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) in train_dataloader:
         print('user_ID', user_ID.size(), user_ID.dtype)
         print('user_category', user_category.size(), user_category.dtype)
@@ -161,7 +461,6 @@ if __name__ == '__main__':
         print('user_abstract_mask', user_abstract_mask.size(), user_abstract_mask.dtype)
         print('user_abstract_entity', user_abstract_entity.size(), user_abstract_entity.dtype)
         print('user_history_mask', user_history_mask.size(), user_history_mask.dtype)
-        print('user_history_graph', user_history_graph.size(), user_history_graph.dtype)
         print('user_history_category_mask', user_history_category_mask.size(), user_history_category_mask.dtype)
         print('user_history_category_indices', user_history_category_indices.size(), user_history_category_indices.dtype)
         print('news_category', news_category.size(), news_category.dtype)
@@ -192,7 +491,6 @@ if __name__ == '__main__':
         user_abstract_mask_list = user_abstract_mask[0].tolist()
         user_abstract_entity_list = user_abstract_entity[0].tolist()
         user_history_mask_list = user_history_mask[0].tolist()
-        user_history_graph_list = user_history_graph[0].tolist()
         user_history_category_mask_list = user_history_category_mask[0].tolist()
         user_history_category_indices_list = user_history_category_indices[0].tolist()
         news_category_list = news_category[0].tolist()
@@ -205,8 +503,8 @@ if __name__ == '__main__':
         news_abstract_entity_list = news_abstract_entity[0].tolist()
         break
     print('MIND_Dev_Dataset :', len(mind_dev_dataset))
-    dev_dataloader = DataLoader(mind_dev_dataset, batch_size=config.batch_size, shuffle=False, num_workers=config.batch_size // 8 if platform.system() == 'Linux' else 0)
-    for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+    dev_dataloader = DataLoader(mind_dev_dataset, batch_size=config.batch_size, shuffle=False, num_workers=config.num_workers)
+    for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
          news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) in dev_dataloader:
         print('user_ID', user_ID.size(), user_ID.dtype)
         print('user_category', user_category.size(), user_category.dtype)
@@ -218,7 +516,6 @@ if __name__ == '__main__':
         print('user_abstract_mask', user_abstract_mask.size(), user_abstract_mask.dtype)
         print('user_abstract_entity', user_abstract_entity.size(), user_abstract_entity.dtype)
         print('user_history_mask', user_history_mask.size(), user_history_mask.dtype)
-        print('user_history_graph', user_history_graph.size(), user_history_graph.dtype)
         print('user_history_category_mask', user_history_category_mask.size(), user_history_category_mask.dtype)
         print('user_history_category_indices', user_history_category_indices.size(), user_history_category_indices.dtype)
         print('news_category', news_category.size(), news_category.dtype)
@@ -232,8 +529,8 @@ if __name__ == '__main__':
         break
     print(len(mind_corpus.dev_indices))
     print('MIND_Test_Dataset :', len(mind_test_dataset))
-    test_dataloader = DataLoader(mind_test_dataset, batch_size=config.batch_size, shuffle=False, num_workers=config.batch_size // 8 if platform.system() == 'Linux' else 0)
-    for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+    test_dataloader = DataLoader(mind_test_dataset, batch_size=config.batch_size, shuffle=False, num_workers=config.num_workers)
+    for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
          news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) in test_dataloader:
         print('user_ID', user_ID.size(), user_ID.dtype)
         print('user_category', user_category.size(), user_category.dtype)
@@ -245,7 +542,6 @@ if __name__ == '__main__':
         print('user_abstract_mask', user_abstract_mask.size(), user_abstract_mask.dtype)
         print('user_abstract_entity', user_abstract_entity.size(), user_abstract_entity.dtype)
         print('user_history_mask', user_history_mask.size(), user_history_mask.dtype)
-        print('user_history_graph', user_history_graph.size(), user_history_graph.dtype)
         print('user_history_category_mask', user_history_category_mask.size(), user_history_category_mask.dtype)
         print('user_history_category_indices', user_history_category_indices.size(), user_history_category_indices.dtype)
         print('news_category', news_category.size(), news_category.dtype)
@@ -1,4 +1,5 @@
 import os
+import platform
 import argparse
 import time
 import torch
@@ -12,12 +13,15 @@ class Config:
     def parse_argument(self):
         parser = argparse.ArgumentParser(description='Neural news recommendation')
         # General config
-        parser.add_argument('--mode', type=str, default='train', choices=['train', 'dev', 'test'], help='Mode')
+        parser.add_argument('--mode', type=str, default='train', choices=['train', 'dev', 'test', 'predict', 'eval'], help='Mode (predict streams the test behaviors and only writes the ranking result file, eval evaluates several model checkpoints in one process)')
         parser.add_argument('--news_encoder', type=str, default='CNE', choices=['CNE', 'CNN', 'MHSA', 'KCNN', 'PCNN', 'HDC', 'NAML', 'PNE', 'DAE', 'Inception', 'NAML_Title', 'NAML_Content', 'CNE_Title', 'CNE_Content', 'CNE_wo_CS', 'CNE_wo_CA'], help='News encoder')
         parser.add_argument('--user_encoder', type=str, default='SUE', choices=['SUE', 'LSTUR', 'MHSA', 'ATT', 'CATT', 'FIM', 'ARNN', 'PUE', 'GRU', 'OMAP', 'SUE_wo_GCN', 'SUE_wo_HCA'], help='User encoder')
         parser.add_argument('--dev_model_path', type=str, default='', help='Dev model path')
         parser.add_argument('--test_model_path', type=str, default='', help='Test model path')
         parser.add_argument('--test_output_file', type=str, default='', help='Specific test output file')
+        parser.add_argument('--eval_model_paths', type=str, nargs='+', default=[], help='Model paths or glob patterns (e.g., ./models/CNE-SUE/#1/*) of eval mode')
+        parser.add_argument('--eval_splits', type=str, nargs='+', default=['dev', 'test'], choices=['dev', 'test'], help='Splits of eval mode')
+        parser.add_argument('--device', type=str, default='cuda', choices=['cuda', 'cpu'], help='Device to run the model on')
         parser.add_argument('--device_id', type=int, default=0, help='Device ID of GPU')
         parser.add_argument('--seed', type=int, default=0, help='Seed for random number generator')
         parser.add_argument('--config_file', type=str, default='', help='Config file path')
@@ -27,8 +31,12 @@ class Config:
         parser.add_argument('--test_root', type=str, default='../MIND/200000/test', help='Directory root of test data')
         parser.add_argument('--tokenizer', type=str, default='MIND', choices=['MIND', 'NLTK'], help='Sentence tokenizer')
         parser.add_argument('--word_threshold', type=int, default=3, help='Word threshold')
+        parser.add_argument('--glove_root', type=str, default='../glove', help='Directory of the GloVe files, a local glove.<corpus>.<dim>d.txt is streamed offline, otherwise GloVe is downloaded by torchtext')
+        parser.add_argument('--random_word_embedding', default=False, action='store_true', help='Whether initialize the word embedding randomly (seeded) without GloVe, e.g., for offline benchmark runs')
+        parser.add_argument('--tokenize_process_num', type=int, default=0, help='Number of processes tokenizing the news in preprocessing (0 for the CPU count)')
         parser.add_argument('--max_title_length', type=int, default=32, help='Sentence truncate length for title')
         parser.add_argument('--max_abstract_length', type=int, default=128, help='Sentence truncate length for abstract')
+        parser.add_argument('--text_length_bucket', type=int, default=8, help='Title and abstract are trimmed per batch to the longest unpadded length rounded up to a multiple of this value (0 for no trimming, ignored by the news encoders whose outputs depend on the padding)')
         # Training config
         parser.add_argument('--negative_sample_num', type=int, default=4, help='Negative sample number of each positive sample')
         parser.add_argument('--max_history_num', type=int, default=50, help='Maximum number of history news for each user')
@@ -37,9 +45,18 @@ class Config:
         parser.add_argument('--lr', type=float, default=1e-4, help='Learning rate')
         parser.add_argument('--weight_decay', type=float, default=0, help='Optimizer weight decay')
         parser.add_argument('--gradient_clip_norm', type=float, default=4, help='Gradient clip norm (non-positive value for no clipping)')
+        parser.add_argument('--train_stream', default=False, action='store_true', help='Whether stream the training behaviors from preprocessed shards on disk instead of loading them into memory (out-of-core training)')
+        parser.add_argument('--train_shard_impression_num', type=int, default=100000, help='Number of training impressions per shard in out-of-core training')
+        parser.add_argument('--shuffle_buffer_size', type=int, default=500000, help='Number of training samples shuffled together in out-of-core training')
+        parser.add_argument('--prefetch_batch_num', type=int, default=2, help='Number of batches assembled and transferred to the device ahead of the computation on a background thread (0 for no prefetching)')
         # Dev config
         parser.add_argument('--dev_criterion', type=str, default='auc', choices=['auc', 'mrr', 'ndcg', 'ndcg10'], help='Validation criterion to select model')
         parser.add_argument('--early_stopping_epoch', type=int, default=5, help='Epoch number of stop training after dev result does not improve')
+        parser.add_argument('--eval_mode', type=str, default='impression', choices=['pair', 'impression', 'catalog'], help='Evaluation batching, per (impression, candidate) pair, per impression (user history encoded once for all candidates), or per impression with news representations precomputed over the whole news catalog (falls back to impression for PNE and HDC)')
+        parser.add_argument('--eval_memory_budget', type=int, default=0, help='Memory budget (MB) of the candidate scoring step in impression and catalog evaluation, impressions exceeding it are scored in candidate chunks (non-positive value for no limit)')
+        parser.add_argument('--no_result_file', default=False, action='store_true', help='Whether not to write the ranking result file in evaluation (the metrics are computed in memory)')
+        parser.add_argument('--device_news_tables', default=False, action='store_true', help='Whether upload the news feature tables to the device once, so that the batches only carry news indices')
+        parser.add_argument('--predict_impression_num', type=int, default=8192, help='Number of test impressions read and scored at a time in predict mode')
         # Model config
         parser.add_argument('--word_embedding_dim', type=int, default=300, choices=[50, 100, 200, 300], help='Word embedding dimension')
         parser.add_argument('--entity_embedding_dim', type=int, default=100, choices=[100], help='Entity embedding dimension')
@@ -90,6 +107,8 @@ class Config:
                             setattr(self, attribute, configs[attribute])
             else:
                 raise Exception('Config file does not exist: ' + self.config_file)
+        self.word_embedding_source = 'random' if self.random_word_embedding else 'glove.' + ('840B' if self.word_embedding_dim == 300 else '6B') # part of the word embedding file name, so that the random and GloVe embeddings are cached apart
+        assert self.text_length_bucket >= 0, 'Text length bucket must be non-negative'
         assert not (self.no_self_connection and not self.no_adjacent_normalization), 'Adjacent normalization of graph only can be set in case of self-connection'
         print('*' * 32 + ' Experiment setting ' + '*' * 32)
         for attribute in self.attribute_dict:
@@ -97,16 +116,23 @@ class Config:
         print('*' * 32 + ' Experiment setting ' + '*' * 32)
 
 
-    def set_cuda(self):
-        gpu_available = torch.cuda.is_available()
-        assert gpu_available, 'GPU is not available'
-        torch.cuda.set_device(self.device_id)
+    def set_device(self):
+        if self.device == 'cuda':
+            gpu_available = torch.cuda.is_available()
+            assert gpu_available, 'GPU is not available, use --device cpu to run on CPU'
+            torch.cuda.set_device(self.device_id)
+            torch.cuda.manual_seed(self.seed)
+            torch.backends.cudnn.benchmark = False
+            torch.backends.cudnn.deterministic = True # For reproducibility
+            self.num_workers = self.batch_size // 8
+        else:
+            # the DataLoader workers compete with the intra-op threads of the model for the CPU cores
+            self.num_workers = min(self.batch_size // 8, (os.cpu_count() or 1) // 4)
+        self.num_workers = self.num_workers if platform.system() == 'Linux' else 0
+        self.pin_memory = self.device == 'cuda' # pinned host memory only speeds up host-to-GPU copies
         torch.manual_seed(self.seed)
-        torch.cuda.manual_seed(self.seed)
         random.seed(self.seed)
         np.random.seed(self.seed)
-        torch.backends.cudnn.benchmark = False
-        torch.backends.cudnn.deterministic = True # For reproducibility
 
 
     def preliminary_setup(self):
@@ -149,7 +175,7 @@ class Config:
 
     def __init__(self):
         self.parse_argument()
-        self.set_cuda()
+        self.set_device()
         self.preliminary_setup()
 
 
@@ -1,99 +1,186 @@
 #!/usr/bin/env python
 import sys, os, os.path
 import numpy as np
-import json
-from sklearn.metrics import roc_auc_score
+from multiprocessing import Pool
 
-def dcg_score(y_true, y_score, k=10):
-    order = np.argsort(y_score)[::-1]
-    y_true = np.take(y_true, order[:k])
-    gains = 2 ** y_true - 1
-    discounts = np.log2(np.arange(len(y_true)) + 2)
-    return np.sum(gains / discounts)
-    
+def impression_offsets(impression_indices):
+    # start offset of each impression in the flat arrays, the candidates of an impression must be contiguous
+    impression_indices = np.asarray(impression_indices)
+    return np.concatenate([[0], np.flatnonzero(impression_indices[1:] != impression_indices[:-1]) + 1]).astype(np.int64)
 
-def ndcg_score(y_true, y_score, k=10):
-    best = dcg_score(y_true, y_true, k)
-    actual = dcg_score(y_true, y_score, k)
-    return actual / best
+def segment_positions(offsets, lengths):
+    # 1-based position of each candidate in its impression
+    return np.arange(lengths.sum()) - np.repeat(offsets, lengths) + 1
 
+def is_permutation(ranks, offsets, lengths):
+    # whether the ranks of each impression are exactly 1, 2, ..., impression length
+    segment_lengths = np.repeat(lengths, lengths)
+    if np.any(ranks != np.floor(ranks)) or np.any(ranks < 1) or np.any(ranks > segment_lengths):
+        return False
+    return np.bincount(np.repeat(offsets, lengths) + ranks.astype(np.int64) - 1, minlength=ranks.shape[0]).max() == 1
 
-def mrr_score(y_true, y_score):
-    order = np.argsort(y_score)[::-1]
-    y_true = np.take(y_true, order)
-    rr_score = y_true / (np.arange(len(y_true)) + 1)
-    return np.sum(rr_score) / np.sum(y_true)
+def impression_metrics(labels, ranks, offsets, impression_base=0):
+    # labels and ranks are flat arrays over all candidates, the candidates of impression i are [offsets[i], offsets[i+1])
+    # impression_base is the index of the first impression among all impressions, e.g., of a chunk scored by a worker process
+    # the metrics are computed on score = 1 / rank as in the per-impression scorer of the MIND benchmark
+    labels = np.asarray(labels, dtype=np.float64)
+    ranks = np.asarray(ranks, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    num = labels.shape[0]
+    lengths = np.diff(np.append(offsets, num))
+    pos_num = np.add.reduceat(labels, offsets)
+    neg_num = lengths - pos_num
+    if np.any(pos_num * neg_num == 0):
+        raise ValueError("Impression-{}: AUC is not defined with only one class".format(impression_base + np.flatnonzero(pos_num * neg_num == 0)[0] + 1))
+    # position of each candidate by descending score
+    if is_permutation(ranks, offsets, lengths):
+        positions = ranks
+        average_positions = ranks
+    else:
+        # tied candidates are placed in reversed candidate order as a stable np.argsort(y_score)[::-1] (the default unstable sort leaves it platform dependent),
+        # and share their average position in AUC
+        impressions = np.repeat(np.arange(offsets.shape[0]), lengths)
+        order = np.lexsort((-np.arange(num), ranks, impressions))
+        sorted_positions = segment_positions(offsets, lengths).astype(np.float64)
+        sorted_ranks = ranks[order]
+        tie_start = np.ones([num], dtype=bool)
+        tie_start[1:] = sorted_ranks[1:] != sorted_ranks[:-1]
+        tie_start[offsets] = True
+        tie_offsets = np.flatnonzero(tie_start)
+        tie_lengths = np.diff(np.append(tie_offsets, num))
+        positions = np.empty([num], dtype=np.float64)
+        positions[order] = sorted_positions
+        average_positions = np.empty([num], dtype=np.float64)
+        average_positions[order] = np.repeat(sorted_positions[tie_offsets] + (tie_lengths - 1) / 2, tie_lengths)
+    # AUC: rank-sum (Mann-Whitney) statistic over the positions by ascending score
+    aucs = (np.add.reduceat(labels * (np.repeat(lengths, lengths) + 1 - average_positions), offsets) - pos_num * (pos_num + 1) / 2) / (pos_num * neg_num)
+    mrrs = np.add.reduceat(labels / positions, offsets) / pos_num
+    gains = (2 ** labels - 1) / np.log2(positions + 1)
+    if np.all((labels == 0) | (labels == 1)):
+        # the ideal ranking of binary labels puts all clicked news first
+        ideal_dcg = lambda k: np.append(0, np.cumsum(1 / np.log2(np.arange(k) + 2)))[np.minimum(pos_num, k).astype(np.int64)]
+    else:
+        ideal_labels = labels[np.lexsort((-labels, np.repeat(np.arange(offsets.shape[0]), lengths)))]
+        ideal_positions = segment_positions(offsets, lengths)
+        ideal_dcg = lambda k: np.add.reduceat((2 ** ideal_labels - 1) / np.log2(ideal_positions + 1) * (ideal_positions <= k), offsets)
+    ndcg_score = lambda k: np.add.reduceat(gains * (positions <= k), offsets) / ideal_dcg(k)
+    return aucs, mrrs, ndcg_score(5), ndcg_score(10)
+
+def scoring_arrays(labels, ranks, offsets, processes=1):
+    labels = np.asarray(labels)
+    ranks = np.asarray(ranks)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if processes <= 1 or offsets.shape[0] < processes:
+        aucs, mrrs, ndcg5s, ndcg10s = impression_metrics(labels, ranks, offsets)
+    else:
+        # fan out chunks of whole impressions with about the same number of candidates
+        num = labels.shape[0]
+        boundaries = np.unique(np.searchsorted(offsets, np.arange(processes) * num // processes, side='right') - 1)
+        starts = offsets[boundaries]
+        ends = np.append(starts[1:], num)
+        chunks = [(labels[start: end], ranks[start: end], offsets[i: j] - start, i) for start, end, i, j in zip(starts, ends, boundaries, np.append(boundaries[1:], offsets.shape[0]))]
+        with Pool(processes) as pool:
+            metrics = pool.starmap(impression_metrics, chunks)
+        aucs, mrrs, ndcg5s, ndcg10s = [np.concatenate(metric) for metric in zip(*metrics)]
+    return np.mean(aucs), np.mean(mrrs), np.mean(ndcg5s), np.mean(ndcg10s)
 
 def parse_line(l):
     impid, ranks = l.strip('\n').split()
-    ranks = json.loads(ranks)
-    return impid, ranks
-
-def scoring(truth_f, sub_f):
-    aucs = []
-    mrrs = []
-    ndcg5s = []
-    ndcg10s = []
-    
+    ranks = ranks.strip()
+    if ranks[0] != '[' or ranks[-1] != ']':
+        raise ValueError(ranks)
+    return impid, ranks[1:-1]
+
+def is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+def parse_array(s):
+    # comma-separated numbers converted in one call, a ValueError is raised by any non-number (the integer ranks are checked on the array by is_permutation)
+    return np.array(s.split(','), dtype=np.float64)
+
+def load_arrays(truth_f, sub_f):
+    # load the truth and submission files into flat label & rank arrays with per-impression offsets
+    label_strs = []
+    rank_strs = []
+    lengths = []
+
     line_index = 1
     for lt in truth_f:
         ls = sub_f.readline()
         impid, labels = parse_line(lt)
-        
+
         # ignore masked impressions
-        if labels == []:
-            continue 
-        
+        if labels == '':
+            continue
+        lt_len = labels.count(',') + 1
+
         if ls == '':
             # empty line: filled with 0 ranks
             sub_impid = impid
-            sub_ranks = [1] * len(labels)
+            sub_ranks = ','.join(['1'] * lt_len)
         else:
             try:
                 sub_impid, sub_ranks = parse_line(ls)
             except:
-                raise ValueError("line-{}: Invalid Input Format!".format(line_index))       
-        
+                raise ValueError("line-{}: Invalid Input Format!".format(line_index))
+
         if sub_impid != impid:
             raise ValueError("line-{}: Inconsistent Impression Id {} and {}".format(
                 line_index,
                 sub_impid,
                 impid
-            ))        
-        
-        lt_len = float(len(labels))
-        
-        y_true =  np.array(labels,dtype='float32')
-        y_score = []
-        for rank in sub_ranks:
-            score_rslt = 1./rank
-            if score_rslt < 0 or score_rslt > 1:
-                raise ValueError("Line-{}: score_rslt should be int from 0 to {}".format(
-                    line_index,
-                    lt_len
-                ))
-            y_score.append(score_rslt)
-            
-        auc = roc_auc_score(y_true,y_score)
-        mrr = mrr_score(y_true,y_score)
-        ndcg5 = ndcg_score(y_true,y_score,5)
-        ndcg10 = ndcg_score(y_true,y_score,10)
-        
-        aucs.append(auc)
-        mrrs.append(mrr)
-        ndcg5s.append(ndcg5)
-        ndcg10s.append(ndcg10)
-        
+            ))
+
+        if sub_ranks == '' or sub_ranks.count(',') + 1 != lt_len:
+            raise ValueError("line-{}: Inconsistent Candidate Number {} and {}".format(
+                line_index,
+                0 if sub_ranks == '' else sub_ranks.count(',') + 1,
+                lt_len
+            ))
+
+        label_strs.append(labels)
+        rank_strs.append(sub_ranks)
+        lengths.append(lt_len)
+
         line_index += 1
 
-    return np.mean(aucs), np.mean(mrrs), np.mean(ndcg5s), np.mean(ndcg10s)
-        
+    lengths = np.array(lengths, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    if len(lengths) == 0:
+        return np.zeros([0], dtype=np.float64), np.zeros([0], dtype=np.float64), offsets
+    labels = parse_array(','.join(label_strs))
+    try:
+        ranks = parse_array(','.join(rank_strs))
+        assert ranks.shape[0] == labels.shape[0]
+    except (ValueError, AssertionError):
+        line_index = next(i for i, sub_ranks in enumerate(rank_strs) if not all(is_number(rank) for rank in sub_ranks.split(',')))
+        raise ValueError("line-{}: Invalid Input Format!".format(line_index + 1))
+    invalid = np.flatnonzero(~(ranks >= 1))
+    if invalid.shape[0] > 0:
+        line_index = np.searchsorted(offsets, invalid[0], side='right')
+        raise ValueError("Line-{}: score_rslt should be int from 0 to {}".format(
+            line_index,
+            lengths[line_index - 1]
+        ))
+    return labels, ranks, offsets
+
+def scoring(truth_f, sub_f, processes=1):
+    labels, ranks, offsets = load_arrays(truth_f, sub_f)
+    if offsets.shape[0] == 0:
+        return np.nan, np.nan, np.nan, np.nan
+    return scoring_arrays(labels, ranks, offsets, processes)
+
 
 if __name__ == '__main__':
     input_dir = sys.argv[1]
     output_dir = sys.argv[2]
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else 1
 
-    submit_dir = os.path.join(input_dir, 'res') 
+    submit_dir = os.path.join(input_dir, 'res')
     truth_dir = os.path.join(input_dir, 'ref')
 
     if not os.path.isdir(submit_dir):
@@ -103,13 +190,13 @@ if __name__ == '__main__':
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        output_filename = os.path.join(output_dir, 'scores.txt')              
+        output_filename = os.path.join(output_dir, 'scores.txt')
         output_file = open(output_filename, 'w')
 
         truth_file = open(os.path.join(truth_dir, "truth.txt"), 'r')
         submission_answer_file = open(os.path.join(submit_dir, "prediction.txt"), 'r')
-        
-        auc, mrr, ndcg, ndcg10 = scoring(truth_file, submission_answer_file)
+
+        auc, mrr, ndcg, ndcg10 = scoring(truth_file, submission_answer_file, processes)
 
         output_file.write("AUC:{:.4f}\nMRR:{:.4f}\nnDCG@5:{:.4f}\nnDCG@10:{:.4f}".format(auc, mrr, ndcg, ndcg10))
         output_file.close()
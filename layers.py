@@ -24,7 +24,6 @@ class Conv1D(nn.Module):
             self.conv3 = nn.Conv1d(in_channels=self.in_channels, out_channels=cnn_kernel_num // 5, kernel_size=3, padding=1)
             self.conv4 = nn.Conv1d(in_channels=self.in_channels, out_channels=cnn_kernel_num // 5, kernel_size=4, padding=1)
             self.conv5 = nn.Conv1d(in_channels=self.in_channels, out_channels=cnn_kernel_num // 5, kernel_size=5, padding=2)
-        self.device = torch.device('cuda')
 
     # Input
     # feature : [batch_size, feature_dim, length]
@@ -36,7 +35,7 @@ class Conv1D(nn.Module):
         elif self.cnn_method == 'group3':
             return F.relu(torch.cat([self.conv1(feature), self.conv2(feature), self.conv3(feature)], dim=1))
         else:
-            padding_zeros = torch.zeros([feature.size(0), self.in_channels, 1], device=self.device)
+            padding_zeros = torch.zeros([feature.size(0), self.in_channels, 1], device=feature.device)
             return F.relu(torch.cat([self.conv1(feature), \
                                      self.conv2(torch.cat([feature, padding_zeros], dim=1)), \
                                      self.conv3(feature), \
@@ -65,7 +64,6 @@ class Conv2D_Pool(nn.Module):
             self.conv2 = nn.Conv2d(in_channels=self.in_channels, out_channels=cnn_kernel_num // 4, kernel_size=[2, last_channel_num], padding=[0, 0])
             self.conv3 = nn.Conv2d(in_channels=self.in_channels, out_channels=cnn_kernel_num // 4, kernel_size=[3, last_channel_num], padding=[1, 0])
             self.conv4 = nn.Conv2d(in_channels=self.in_channels, out_channels=cnn_kernel_num // 4, kernel_size=[4, last_channel_num], padding=[1, 0])
-        self.device = torch.device('cuda')
 
     # Input
     # feature : [batch_size, feature_dim, length]
@@ -78,7 +76,7 @@ class Conv2D_Pool(nn.Module):
             conv_relu_pool, _ = torch.max(conv_relu[:, :, :length - self.cnn_window_size + 1], dim=2, keepdim=False) # [batch_size, cnn_kernel_num]
             return conv_relu_pool
         elif self.cnn_method == 'group3':
-            padding_zeros = torch.zeros([feature.size(0), self.in_channels, 1, self.last_channel_num], device=self.device)
+            padding_zeros = torch.zeros([feature.size(0), self.in_channels, 1, self.last_channel_num], device=feature.device)
             conv1_relu = F.relu(self.conv1(feature), inplace=True)
             conv1_relu_pool, _ = torch.max(conv1_relu, dim=2, keepdim=False)
             conv2_relu = F.relu(self.conv2(torch.cat([feature, padding_zeros], dim=2)), inplace=True)
@@ -87,7 +85,7 @@ class Conv2D_Pool(nn.Module):
             conv3_relu_pool, _ = torch.max(conv3_relu[:, :, :length - 2], dim=2, keepdim=False)
             return torch.cat([conv1_relu_pool, conv2_relu_pool, conv3_relu_pool], dim=1)
         else:
-            padding_zeros = torch.zeros([feature.size(0), self.in_channels, 1, self.last_channel_num], device=self.device)
+            padding_zeros = torch.zeros([feature.size(0), self.in_channels, 1, self.last_channel_num], device=feature.device)
             conv1_relu = F.relu(self.conv1(feature), inplace=True)
             conv1_relu_pool, _ = torch.max(conv1_relu, dim=2, keepdim=False)
             conv2_relu = F.relu(self.conv2(torch.cat([feature, padding_zeros], dim=2)), inplace=True)
@@ -131,20 +129,22 @@ class MultiHeadAttention(nn.Module):
     # out  : [batch_size, len_q, h * d_v]
     def forward(self, Q, K, V, mask=None):
         batch_size = Q.size(0)
-        Q = self.W_Q(Q).view([batch_size, self.len_q, self.h, self.d_k])                                           # [batch_size, len_q, h, d_k]
-        K = self.W_K(K).view([batch_size, self.len_k, self.h, self.d_k])                                           # [batch_size, len_k, h, d_k]
-        V = self.W_V(V).view([batch_size, self.len_k, self.h, self.d_v])                                           # [batch_size, len_k, h, d_v]
-        Q = Q.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, self.len_q, self.d_k])                   # [batch_size * h, len_q, d_k]
-        K = K.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, self.len_k, self.d_k])                   # [batch_size * h, len_k, d_k]
-        V = V.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, self.len_k, self.d_v])                   # [batch_size * h, len_k, d_v]
-        A = torch.bmm(Q, K.permute(0, 2, 1).contiguous()) / self.attention_scalar                                  # [batch_size * h, len_q, len_k]
+        len_q = Q.size(1)
+        len_k = K.size(1)
+        Q = self.W_Q(Q).view([batch_size, len_q, self.h, self.d_k])                                      # [batch_size, len_q, h, d_k]
+        K = self.W_K(K).view([batch_size, len_k, self.h, self.d_k])                                      # [batch_size, len_k, h, d_k]
+        V = self.W_V(V).view([batch_size, len_k, self.h, self.d_v])                                      # [batch_size, len_k, h, d_v]
+        Q = Q.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, len_q, self.d_k])              # [batch_size * h, len_q, d_k]
+        K = K.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, len_k, self.d_k])              # [batch_size * h, len_k, d_k]
+        V = V.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, len_k, self.d_v])              # [batch_size * h, len_k, d_v]
+        A = torch.bmm(Q, K.permute(0, 2, 1).contiguous()) / self.attention_scalar                        # [batch_size * h, len_q, len_k]
         if mask != None:
-            _mask = mask.repeat([1, self.h]).view([batch_size * self.h, 1, self.len_k]).repeat([1, self.len_q, 1]) # [batch_size * h, len_q, len_k]
-            alpha = F.softmax(A.masked_fill(_mask == 0, -1e9), dim=2)                                              # [batch_size * h, len_q, len_k]
+            _mask = mask.repeat([1, self.h]).view([batch_size * self.h, 1, len_k]).repeat([1, len_q, 1]) # [batch_size * h, len_q, len_k]
+            alpha = F.softmax(A.masked_fill(_mask == 0, -1e9), dim=2)                                    # [batch_size * h, len_q, len_k]
         else:
-            alpha = F.softmax(A, dim=2)                                                                            # [batch_size * h, len_q, len_k]
-        out = torch.bmm(alpha, V).view([batch_size, self.h, self.len_q, self.d_v])                                 # [batch_size, h, len_q, d_v]
-        out = out.permute([0, 2, 1, 3]).contiguous().view([batch_size, self.len_q, self.out_dim])                  # [batch_size, len_q, h * d_v]
+            alpha = F.softmax(A, dim=2)                                                                  # [batch_size * h, len_q, len_k]
+        out = torch.bmm(alpha, V).view([batch_size, self.h, len_q, self.d_v])                            # [batch_size, h, len_q, d_v]
+        out = out.permute([0, 2, 1, 3]).contiguous().view([batch_size, len_q, self.out_dim])             # [batch_size, len_q, h * d_v]
         return out
 
 
@@ -322,3 +322,41 @@ class GCN(nn.Module):
             out = self.dropout(self.gcn_layers[i](out, graph))
         out = self.gcn_layers[self.num_layers - 1](out, graph)
         return out
+
+
+# Batched construction of the SUE user history graphs from the history category indices, on the device of the indices
+# The nodes are the max_history_num history news followed by the category_num category proxy nodes, with the edges
+# E_{n}   : between history news of the same category (intra-cluster graph G1)
+# E_{p}^1 : between a history news and the proxy node of its category (inter-cluster graph G2)
+# E_{p}^2 : between the proxy nodes of different categories in the history (inter-cluster graph G2)
+class HistoryGraph(nn.Module):
+    def __init__(self, max_history_num, category_num, self_connection=True, normalization_type=None):
+        super(HistoryGraph, self).__init__()
+        self.max_history_num = max_history_num
+        self.category_num = category_num
+        self.self_connection = self_connection
+        self.normalization_type = normalization_type # 'symmetric', 'asymmetric' or None
+
+    # Input
+    # history_category_indices : [batch_size, max_history_num] (category_num for padding news)
+    # Output
+    # graph                    : [batch_size, max_history_num + category_num, max_history_num + category_num]
+    def forward(self, history_category_indices, dtype=torch.float32):
+        history_category = F.one_hot(history_category_indices, self.category_num + 1)[:, :, :self.category_num].to(dtype)        # [batch_size, max_history_num, category_num]
+        category_presence = history_category.max(dim=1, keepdim=False)[0]                                                       # [batch_size, category_num]
+        news_graph = torch.bmm(history_category, history_category.permute(0, 2, 1))                                           # [batch_size, max_history_num, max_history_num]
+        proxy_graph = category_presence.unsqueeze(dim=2) * category_presence.unsqueeze(dim=1)                                   # [batch_size, category_num, category_num]
+        news_graph.diagonal(dim1=1, dim2=2).fill_(0)
+        proxy_graph.diagonal(dim1=1, dim2=2).fill_(0)
+        graph = torch.cat([torch.cat([news_graph, history_category], dim=2), torch.cat([history_category.permute(0, 2, 1), proxy_graph], dim=2)], dim=1)
+        if self.self_connection:
+            graph.diagonal(dim1=1, dim2=2).fill_(1)
+        if self.normalization_type is not None:
+            degree = graph.sum(dim=2, keepdim=False)                                                                            # [batch_size, max_history_num + category_num]
+            degree_inv = torch.where(degree > 0, 1 / degree, torch.zeros_like(degree))
+            if self.normalization_type == 'asymmetric':
+                graph = degree_inv.unsqueeze(dim=2) * graph
+            else:
+                degree_inv_sqrt = torch.sqrt(degree_inv)
+                graph = degree_inv_sqrt.unsqueeze(dim=2) * graph * degree_inv_sqrt.unsqueeze(dim=1)
+        return graph
@@ -1,4 +1,6 @@
 import os
+import re
+import glob
 from sklearn.metrics import roc_auc_score
 from config import Config
 import torch
@@ -6,12 +8,20 @@ from MIND_corpus import MIND_Corpus
 from model import Model
 from trainer import Trainer
 from util import compute_scores
+from util import predict_scores
+from util import get_eval_mode
+from util import get_eval_dataset
+from util import compute_news_table
+from util import join_result_file_writer
 
 
 def train(config: Config, mind_corpus: MIND_Corpus):
     model = Model(config)
+    if config.device_news_tables:
+        model.load_news_tables(mind_corpus)
     model.initialize()
-    model.cuda()
+    model.to(torch.device(config.device))
+    model.check_text_trimming(mind_corpus)
     trainer = Trainer(model, config, mind_corpus)
     trainer.train()
     return trainer
@@ -19,12 +29,15 @@ def train(config: Config, mind_corpus: MIND_Corpus):
 
 def dev(config: Config, mind_corpus: MIND_Corpus):
     model = Model(config)
+    if config.device_news_tables:
+        model.load_news_tables(mind_corpus)
     model.load_state_dict(torch.load(config.dev_model_path, map_location=torch.device('cpu'))[model.model_name])
-    model.cuda()
+    model.to(torch.device(config.device))
+    model.check_text_trimming(mind_corpus)
     dev_result_path = './dev/res/' + config.dev_model_path.replace('\\', '@').replace('/', '@')
     if not os.path.exists(dev_result_path):
         os.mkdir(dev_result_path)
-    auc, mrr, ndcg, ndcg10 = compute_scores(model, mind_corpus, config.batch_size, 'dev', dev_result_path + '/' + model.model_name + '.txt')
+    auc, mrr, ndcg, ndcg10 = compute_scores(model, mind_corpus, config, 'dev', dev_result_path + '/' + model.model_name + '.txt')
     print('Dev : ' + config.dev_model_path)
     print('AUC : %.4f\nMRR : %.4f\nnDCG@5 : %.4f\nnDCG@10 : %.4f' % (auc, mrr, ndcg, ndcg10))
     return auc, mrr, ndcg, ndcg10
@@ -32,12 +45,15 @@ def dev(config: Config, mind_corpus: MIND_Corpus):
 
 def test(config: Config, mind_corpus: MIND_Corpus):
     model = Model(config)
+    if config.device_news_tables:
+        model.load_news_tables(mind_corpus)
     model.load_state_dict(torch.load(config.test_model_path, map_location=torch.device('cpu'))[model.model_name])
-    model.cuda()
+    model.to(torch.device(config.device))
+    model.check_text_trimming(mind_corpus)
     test_result_path = './test/res/' + config.test_model_path.replace('\\', '@').replace('/', '@')
     if not os.path.exists(test_result_path):
         os.mkdir(test_result_path)
-    auc, mrr, ndcg, ndcg10 = compute_scores(model, mind_corpus, config.batch_size, 'test', test_result_path + '/' + model.model_name + '.txt')
+    auc, mrr, ndcg, ndcg10 = compute_scores(model, mind_corpus, config, 'test', test_result_path + '/' + model.model_name + '.txt')
     print('Test : ' + config.test_model_path)
     print('AUC : %.4f\nMRR : %.4f\nnDCG@5 : %.4f\nnDCG@10 : %.4f' % (auc, mrr, ndcg, ndcg10))
     if config.mode == 'test' and config.test_output_file != '':
@@ -46,6 +62,57 @@ def test(config: Config, mind_corpus: MIND_Corpus):
     return auc, mrr, ndcg, ndcg10
 
 
+def predict(config: Config, mind_corpus: MIND_Corpus):
+    model = Model(config)
+    if config.device_news_tables:
+        model.load_news_tables(mind_corpus)
+    model.load_state_dict(torch.load(config.test_model_path, map_location=torch.device('cpu'))[model.model_name])
+    model.to(torch.device(config.device))
+    model.check_text_trimming(mind_corpus)
+    test_result_path = './test/res/' + config.test_model_path.replace('\\', '@').replace('/', '@')
+    if not os.path.exists(test_result_path):
+        os.mkdir(test_result_path)
+    result_file = test_result_path + '/' + model.model_name + '.txt'
+    impression_num = predict_scores(model, mind_corpus, config, os.path.join(config.test_root, 'behaviors.tsv'), result_file)
+    print('Predict : ' + config.test_model_path)
+    print('%d impressions ranked in %s' % (impression_num, result_file))
+
+
+# Evaluate several model checkpoints on the dev & test splits in one process, the corpus, the model and the evaluation datasets are built once
+def evaluate_checkpoints(config: Config, mind_corpus: MIND_Corpus):
+    model_paths = []
+    for pattern in config.eval_model_paths:
+        paths = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        model_paths.extend(sorted(filter(os.path.isfile, paths), key=lambda path: [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', path)])) # e.g., epoch 10 after epoch 9
+    assert len(model_paths) > 0, 'No model checkpoint matches ' + str(config.eval_model_paths)
+    model = Model(config)
+    if config.device_news_tables:
+        model.load_news_tables(mind_corpus)
+    model.to(torch.device(config.device))
+    eval_mode = get_eval_mode(model, config)
+    datasets = {split: get_eval_dataset(mind_corpus, eval_mode, split, index_only=config.device_news_tables) for split in config.eval_splits}
+    results = []
+    for model_path in model_paths:
+        model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu'))[model.model_name])
+        model.check_text_trimming(mind_corpus)
+        model.eval()
+        news_table = compute_news_table(model, mind_corpus, config) if eval_mode == 'catalog' else None # shared by the splits
+        for split in config.eval_splits:
+            result_path = './' + split + '/res/' + model_path.replace('\\', '@').replace('/', '@')
+            if not os.path.exists(result_path):
+                os.mkdir(result_path)
+            auc, mrr, ndcg, ndcg10 = compute_scores(model, mind_corpus, config, split, result_path + '/' + model.model_name + '.txt', datasets[split], news_table)
+            results.append([model_path, split, auc, mrr, ndcg, ndcg10])
+            print('%s (%s) : AUC %.4f, MRR %.4f, nDCG@5 %.4f, nDCG@10 %.4f' % (model_path, split, auc, mrr, ndcg, ndcg10))
+    result_file = './results/' + model.model_name + '/eval.tsv'
+    with open(result_file, 'w', encoding='utf-8') as result_f:
+        result_f.write('model_path\tsplit\tAUC\tMRR\tnDCG@5\tnDCG@10\n')
+        for model_path, split, auc, mrr, ndcg, ndcg10 in results:
+            result_f.write('%s\t%s\t%.4f\t%.4f\t%.4f\t%.4f\n' % (model_path, split, auc, mrr, ndcg, ndcg10))
+    print('Evaluation results of %d checkpoints are written to %s' % (len(model_paths), result_file))
+    return results
+
+
 if __name__ == '__main__':
     config = Config()
     mind_corpus = MIND_Corpus(config)
@@ -61,3 +128,8 @@ if __name__ == '__main__':
         dev(config, mind_corpus)
     elif config.mode == 'test':
         test(config, mind_corpus)
+    elif config.mode == 'predict':
+        predict(config, mind_corpus)
+    elif config.mode == 'eval':
+        evaluate_checkpoints(config, mind_corpus)
+    join_result_file_writer() # the last result file may still be written in the background
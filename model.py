@@ -1,3 +1,4 @@
+import math
 from config import Config
 import torch
 import torch.nn as nn
@@ -91,6 +92,9 @@ class Model(nn.Module):
         if config.news_encoder == 'HDC' or config.user_encoder == 'FIM':
             assert config.news_encoder == 'HDC' and config.user_encoder == 'FIM', 'HDC and FIM must be paired and can not be used alone'
             assert config.click_predictor == 'FIM', 'For the model FIM, the click predictor must be specially set as \'FIM\''
+        self.max_title_length = config.max_title_length
+        self.max_abstract_length = config.max_abstract_length
+        self.text_length_bucket = config.text_length_bucket if self.news_encoder.variable_text_length else 0
         self.click_predictor = config.click_predictor
         if self.click_predictor == 'mlp':
             self.mlp = nn.Linear(in_features=self.news_embedding_dim * 2, out_features=self.news_embedding_dim // 2, bias=True)
@@ -109,6 +113,70 @@ class Model(nn.Module):
                            config.conv3D_filter_num_second
             self.fc = nn.Linear(in_features=feature_size, out_features=1, bias=True)
 
+    # Upload the news feature tables of the corpus to the device of the model (--device_news_tables), the tables are buffers out of the state dict
+    def load_news_tables(self, mind_corpus):
+        device = next(self.parameters()).device
+        for feature in ['category', 'subCategory', 'title_text', 'title_mask', 'title_entity', 'abstract_text', 'abstract_mask', 'abstract_entity']:
+            self.register_buffer('news_' + feature + '_table', torch.from_numpy(getattr(mind_corpus, 'news_' + feature)).to(device), persistent=False)
+
+    # Input
+    # news_index           : [*]
+    # Output
+    # news_category        : [*]
+    # news_subCategory     : [*]
+    # news_title_text      : [*, max_title_length]
+    # news_title_mask      : [*, max_title_length]
+    # news_title_entity    : [*, max_title_length]
+    # news_abstract_text   : [*, max_abstract_length]
+    # news_abstract_mask   : [*, max_abstract_length]
+    # news_abstract_entity : [*, max_abstract_length]
+    def gather_news(self, news_index):
+        news_index = news_index.long()
+        return self.news_category_table[news_index], self.news_subCategory_table[news_index], self.news_title_text_table[news_index], self.news_title_mask_table[news_index], self.news_title_entity_table[news_index], \
+               self.news_abstract_text_table[news_index], self.news_abstract_mask_table[news_index], self.news_abstract_entity_table[news_index]
+
+    # Encode the news with the title and abstract trimmed to the longest unpadded length in the batch (--text_length_bucket), the trimmed length is rounded up to a multiple of the bucket to bound the number of distinct shapes
+    # Input
+    # title_text          : [batch_size, news_num, max_title_length]
+    # title_mask          : [batch_size, news_num, max_title_length]
+    # title_entity        : [batch_size, news_num, max_title_length]
+    # abstract_text       : [batch_size, news_num, max_abstract_length]
+    # abstract_mask       : [batch_size, news_num, max_abstract_length]
+    # abstract_entity     : [batch_size, news_num, max_abstract_length]
+    # category            : [batch_size, news_num]
+    # subCategory         : [batch_size, news_num]
+    # user_embedding      : [batch_size, user_embedding_dim]
+    # Output
+    # news_representation : [batch_size, news_num, news_embedding_dim]
+    def encode_news(self, title_text, title_mask, title_entity, abstract_text, abstract_mask, abstract_entity, category, subCategory, user_embedding):
+        if self.text_length_bucket > 0:
+            title_length, abstract_length = torch.stack([title_mask.sum(dim=-1).max(), abstract_mask.sum(dim=-1).max()]).tolist() # one device synchronization for both lengths
+            title_length = min(max(math.ceil(title_length / self.text_length_bucket), 1) * self.text_length_bucket, self.max_title_length)
+            abstract_length = min(max(math.ceil(abstract_length / self.text_length_bucket), 1) * self.text_length_bucket, self.max_abstract_length)
+            if title_length < title_text.size(-1):
+                title_text, title_mask, title_entity = title_text[..., :title_length].contiguous(), title_mask[..., :title_length].contiguous(), title_entity[..., :title_length].contiguous()
+            if abstract_length < abstract_text.size(-1):
+                abstract_text, abstract_mask, abstract_entity = abstract_text[..., :abstract_length].contiguous(), abstract_mask[..., :abstract_length].contiguous(), abstract_entity[..., :abstract_length].contiguous()
+        return self.news_encoder(title_text, title_mask, title_entity, abstract_text, abstract_mask, abstract_entity, category, subCategory, user_embedding)
+
+    # Check that trimming the texts (--text_length_bucket) leaves the news representations unchanged, the first news of the corpus are encoded in small groups, so that most groups are trimmed, with and without trimming
+    def check_text_trimming(self, mind_corpus, news_num=256, group_size=8):
+        if self.text_length_bucket == 0:
+            return
+        training = self.training
+        self.eval()
+        device = next(self.parameters()).device
+        news_num = min(news_num, mind_corpus.news_title_text.shape[0])
+        with torch.no_grad():
+            for i in range(0, news_num, group_size):
+                j = min(i + group_size, news_num)
+                # copied for each encoding, as some news encoders fill the masks in place
+                news_features = [getattr(mind_corpus, 'news_' + feature)[i: j] for feature in ['title_text', 'title_mask', 'title_entity', 'abstract_text', 'abstract_mask', 'abstract_entity', 'category', 'subCategory']]
+                trimmed_news_representation = self.encode_news(*[torch.tensor(news_feature, device=device).unsqueeze(dim=0) for news_feature in news_features], None) # [1, group_size, news_embedding_dim]
+                news_representation = self.news_encoder(*[torch.tensor(news_feature, device=device).unsqueeze(dim=0) for news_feature in news_features], None)       # [1, group_size, news_embedding_dim]
+                assert torch.allclose(trimmed_news_representation, news_representation, rtol=1e-4, atol=1e-5, equal_nan=True), 'News representations of trimmed texts do not match those of full-length texts, set --text_length_bucket=0 for this news encoder'
+        self.train(training)
+
     def initialize(self):
         self.news_encoder.initialize()
         self.user_encoder.initialize()
@@ -122,12 +190,31 @@ class Model(nn.Module):
             nn.init.xavier_uniform_(self.fc.weight)
             nn.init.zeros_(self.fc.bias)
 
-    def forward(self, user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+    def forward(self, user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
                       news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity):
-        user_embedding = self.dropout(self.user_embedding(user_ID)) if self.use_user_embedding else None                                                                                                            # [batch_size, news_embedding_dim]
-        news_representation = self.news_encoder(news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity, news_category, news_subCategory, user_embedding) # [batch_size, 1 + negative_sample_num, news_embedding_dim]
-        user_representation = self.user_encoder(user_ID, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_category, user_subCategory, \
-                                                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, news_representation)                              # [batch_size, 1 + negative_sample_num, news_embedding_dim]
+        user_embedding = self.dropout(self.user_embedding(user_ID)) if self.use_user_embedding else None                                                                                                           # [batch_size, news_embedding_dim]
+        news_representation = self.encode_news(news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity, news_category, news_subCategory, user_embedding) # [batch_size, 1 + negative_sample_num, news_embedding_dim]
+        history_embedding = self.encode_news(user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_category, user_subCategory, user_embedding)   # [batch_size, max_history_num, news_embedding_dim]
+        return self.click_predict(user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding, news_representation)
+
+    def click_predict(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding, news_representation):
+        user_state = self.user_encoder.prepare(user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding)
+        return self.click_score(user_state, news_representation)
+
+    # Two-phase inference: prepare_user (or encode_user from the raw history features) runs the candidate-independent part of the user encoder once per user,
+    # click_score then scores any number of candidate news against the cached user state, e.g., chunk by chunk in util.compute_scores
+    def encode_user(self, user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices):
+        user_embedding = self.dropout(self.user_embedding(user_ID)) if self.use_user_embedding else None                                                                                                         # [batch_size, news_embedding_dim]
+        history_embedding = self.encode_news(user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_category, user_subCategory, user_embedding) # [batch_size, max_history_num, news_embedding_dim]
+        user_state = self.user_encoder.prepare(user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding)
+        return user_state, user_embedding
+
+    def prepare_user(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices):
+        user_embedding = self.dropout(self.user_embedding(user_ID)) if self.use_user_embedding else None # [batch_size, news_embedding_dim]
+        return self.user_encoder.prepare(user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding)
+
+    def click_score(self, user_state, news_representation):
+        user_representation = self.user_encoder.score(user_state, news_representation) # [batch_size, news_num, news_embedding_dim]
         if self.click_predictor == 'dot_product':
             logits = (user_representation * news_representation).sum(dim=2) # dot-product
         elif self.click_predictor == 'mlp':
@@ -14,12 +14,14 @@ class NewsEncoder(nn.Module):
         super(NewsEncoder, self).__init__()
         self.word_embedding_dim = config.word_embedding_dim
         self.word_embedding = nn.Embedding(num_embeddings=config.vocabulary_size, embedding_dim=self.word_embedding_dim)
-        with open('word_embedding-' + str(config.word_threshold) + '-' + str(config.word_embedding_dim) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '.pkl', 'rb') as word_embedding_f:
+        with open('word_embedding-' + str(config.word_threshold) + '-' + str(config.word_embedding_dim) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '-' + config.word_embedding_source + '.pkl', 'rb') as word_embedding_f:
             self.word_embedding.weight.data.copy_(pickle.load(word_embedding_f))
         self.category_embedding = nn.Embedding(num_embeddings=config.category_num, embedding_dim=config.category_embedding_dim)
         self.subCategory_embedding = nn.Embedding(num_embeddings=config.subCategory_num, embedding_dim=config.subCategory_embedding_dim)
         self.dropout = nn.Dropout(p=config.dropout_rate, inplace=True)
         self.auxiliary_loss = None
+        self.catalog_encodable = True # whether the news representations can be precomputed once over the whole news catalog
+        self.variable_text_length = True # whether the title and abstract can be trimmed to a shorter length than max_title_length and max_abstract_length per batch
 
     def initialize(self):
         nn.init.uniform_(self.category_embedding.weight, -0.1, 0.1)
@@ -57,8 +59,6 @@ class NewsEncoder(nn.Module):
 class CNE(NewsEncoder):
     def __init__(self, config: Config):
         super(CNE, self).__init__(config)
-        self.max_title_length = config.max_title_length
-        self.max_content_length = config.max_abstract_length
         self.word_embedding_dim = config.word_embedding_dim
         self.hidden_dim = config.hidden_dim
         self.news_embedding_dim = config.hidden_dim * 4 + config.category_embedding_dim + config.subCategory_embedding_dim
@@ -102,8 +102,8 @@ class CNE(NewsEncoder):
     def forward(self, title_text, title_mask, title_entity, content_text, content_mask, content_entity, category, subCategory, user_embedding):
         batch_size = category.size(0)
         news_num = category.size(1)
-        title_mask = title_mask.view([batch_size * news_num, self.max_title_length])                                                                       # [batch_size * news_num, max_title_length]
-        content_mask = content_mask.view([batch_size * news_num, self.max_content_length])                                                                 # [batch_size * news_num, max_content_length]
+        title_mask = title_mask.view([batch_size * news_num, -1])                                                                                          # [batch_size * news_num, max_title_length]
+        content_mask = content_mask.view([batch_size * news_num, -1])                                                                                      # [batch_size * news_num, max_content_length]
         title_mask[:, 0] = 1.0   # To avoid empty input of LSTM
         content_mask[:, 0] = 1.0 # To avoid empty input of LSTM
         title_length = title_mask.sum(dim=1, keepdim=False).long()                                                                                         # [batch_size * news_num]
@@ -113,8 +113,8 @@ class CNE(NewsEncoder):
         sorted_content_length, sorted_content_indices = torch.sort(content_length, descending=True)                                                        # [batch_size * news_num]
         _, desorted_content_indices = torch.sort(sorted_content_indices, descending=False)                                                                 # [batch_size * news_num]
         # 1. word embedding
-        title = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, self.max_title_length, self.word_embedding_dim])                # [batch_size * news_num, max_title_length, word_embedding_dim]
-        content = self.dropout(self.word_embedding(content_text)).view([batch_size * news_num, self.max_content_length, self.word_embedding_dim])          # [batch_size * news_num, max_content_length, word_embedding_dim]
+        title = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, -1, self.word_embedding_dim])                                   # [batch_size * news_num, max_title_length, word_embedding_dim]
+        content = self.dropout(self.word_embedding(content_text)).view([batch_size * news_num, -1, self.word_embedding_dim])                               # [batch_size * news_num, max_content_length, word_embedding_dim]
         sorted_title = pack_padded_sequence(title.index_select(0, sorted_title_indices), sorted_title_length.cpu(), batch_first=True)                      # [batch_size * news_num, max_title_length, word_embedding_dim]
         sorted_content = pack_padded_sequence(content.index_select(0, sorted_content_indices), sorted_content_length.cpu(), batch_first=True)              # [batch_size * news_num, max_content_length, word_embedding_dim]
         # 2. selective LSTM encoding
@@ -122,10 +122,10 @@ class CNE(NewsEncoder):
         sorted_content_h, (sorted_content_h_n, sorted_content_c_n) = self.content_lstm(sorted_content)
         sorted_title_m = torch.cat([sorted_title_c_n[0], sorted_title_c_n[1]], dim=1)                                                                      # [batch_size * news_num, hidden_dim * 2]
         sorted_content_m = torch.cat([sorted_content_c_n[0], sorted_content_c_n[1]], dim=1)                                                                # [batch_size * news_num, hidden_dim * 2]
-        sorted_title_h, _ = pad_packed_sequence(sorted_title_h, batch_first=True, total_length=self.max_title_length)                                      # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        sorted_content_h, _ = pad_packed_sequence(sorted_content_h, batch_first=True, total_length=self.max_content_length)                                # [batch_size * news_num, max_content_length, hidden_dim * 2]
-        sorted_title_gate = torch.sigmoid(self.title_H(sorted_title_h) + self.title_M(sorted_content_m).unsqueeze(dim=1))                                  # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        sorted_content_gate = torch.sigmoid(self.content_H(sorted_content_h) + self.content_M(sorted_title_m).unsqueeze(dim=1))                            # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        sorted_title_h, _ = pad_packed_sequence(sorted_title_h, batch_first=True, total_length=title_text.size(2))                                         # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        sorted_content_h, _ = pad_packed_sequence(sorted_content_h, batch_first=True, total_length=content_text.size(2))                                   # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        sorted_title_gate = torch.sigmoid(self.title_H(sorted_title_h) + self.title_M(sorted_content_m.index_select(0, desorted_content_indices).index_select(0, sorted_title_indices)).unsqueeze(dim=1))                                  # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        sorted_content_gate = torch.sigmoid(self.content_H(sorted_content_h) + self.content_M(sorted_title_m.index_select(0, desorted_title_indices).index_select(0, sorted_content_indices)).unsqueeze(dim=1))                            # [batch_size * news_num, max_content_length, hidden_dim * 2]
         title_h = (sorted_title_h * sorted_title_gate).index_select(0, desorted_title_indices)                                                             # [batch_size * news_num, max_title_length, hidden_dim * 2]
         content_h = (sorted_content_h * sorted_content_gate).index_select(0, desorted_content_indices)                                                     # [batch_size * news_num, max_content_length, hidden_dim * 2]
         # 3. self-attention
@@ -143,11 +143,11 @@ class CNE(NewsEncoder):
 class CNN(NewsEncoder):
     def __init__(self, config: Config):
         super(CNN, self).__init__(config)
-        self.max_sentence_length = config.max_title_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
         self.attention = Attention(config.cnn_kernel_num, config.attention_dim)
         self.news_embedding_dim = config.cnn_kernel_num + config.category_embedding_dim + config.subCategory_embedding_dim
+        self.variable_text_length = False # the convolution sees the trainable PAD word embedding beyond the last word, which trimming would replace by zero padding
 
     def initialize(self):
         super().initialize()
@@ -156,9 +156,9 @@ class CNN(NewsEncoder):
     def forward(self, title_text, title_mask, title_entity, content_text, content_mask, content_entity, category, subCategory, user_embedding):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
-        mask = title_mask.view([batch_size * news_num, self.max_sentence_length])                                                                           # [batch_size * news_num, max_sentence_length]
+        mask = title_mask.view([batch_size * news_num, -1])                                                                                                 # [batch_size * news_num, max_sentence_length]
         # 1. word embedding
-        w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, self.max_sentence_length, self.word_embedding_dim]).permute(0, 2, 1) # [batch_size * news_num, word_embedding_dim, max_sentence_length]
+        w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, -1, self.word_embedding_dim]).permute(0, 2, 1)                       # [batch_size * news_num, word_embedding_dim, max_sentence_length]
         # 2. CNN encoding
         c = self.dropout(self.conv(w).permute(0, 2, 1))                                                                                                     # [batch_size * news_num, max_sentence_length, cnn_kernel_num]
         # 3. attention layer
@@ -171,11 +171,11 @@ class CNN(NewsEncoder):
 class MHSA(NewsEncoder):
     def __init__(self, config: Config):
         super(MHSA, self).__init__(config)
-        self.max_sentence_length = config.max_title_length
         self.feature_dim = config.head_num * config.head_dim
         self.multiheadAttention = MultiHeadAttention(config.head_num, config.word_embedding_dim, config.max_title_length, config.max_title_length, config.head_dim, config.head_dim)
         self.attention = Attention(config.head_num*config.head_dim, config.attention_dim)
         self.news_embedding_dim = config.head_num * config.head_dim + config.category_embedding_dim + config.subCategory_embedding_dim
+        self.variable_text_length = False # a title without words attends uniformly over all the padded positions
 
     def initialize(self):
         super().initialize()
@@ -185,9 +185,9 @@ class MHSA(NewsEncoder):
     def forward(self, title_text, title_mask, title_entity, content_text, content_mask, content_entity, category, subCategory, user_embedding):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
-        mask = title_mask.view([batch_size * news_num, self.max_sentence_length])                                                          # [batch_size * news_num, max_sentence_length]
+        mask = title_mask.view([batch_size * news_num, -1])                                                                                # [batch_size * news_num, max_sentence_length]
         # 1. word embedding
-        w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, self.max_sentence_length, self.word_embedding_dim]) # [batch_size * news_num, max_sentence_length, word_embedding_dim]
+        w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, -1, self.word_embedding_dim])                       # [batch_size * news_num, max_sentence_length, word_embedding_dim]
         # 2. multi-head self-attention
         c = self.dropout(self.multiheadAttention(w, w, w, mask))                                                                           # [batch_size * news_num, max_sentence_length, news_embedding_dim]
         # 3. attention layer
@@ -200,7 +200,6 @@ class MHSA(NewsEncoder):
 class KCNN(NewsEncoder):
     def __init__(self, config: Config):
         super(KCNN, self).__init__(config)
-        self.max_title_length = config.max_title_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.entity_embedding_dim = config.entity_embedding_dim
         self.context_embedding_dim = config.context_embedding_dim
@@ -214,6 +213,7 @@ class KCNN(NewsEncoder):
         self.M_context = nn.Linear(in_features=self.context_embedding_dim, out_features=self.word_embedding_dim, bias=True)
         self.knowledge_cnn = Conv2D_Pool(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size, 3)
         self.news_embedding_dim = config.cnn_kernel_num + config.category_embedding_dim + config.subCategory_embedding_dim
+        self.variable_text_length = False # the max pooling over the title is not masked, the padded positions are pooled as well
 
     def initialize(self):
         super().initialize()
@@ -226,9 +226,9 @@ class KCNN(NewsEncoder):
         batch_size = category.size(0)
         news_num = category.size(1)
         # 1. word & entity & context embedding
-        word_embedding = self.word_embedding(title_text).view([batch_size * news_num, self.max_title_length, self.word_embedding_dim])                           # [batch_size * news_num, max_title_length, word_embedding_dim]
-        entity_embedding = self.entity_embedding(title_entity).view([batch_size * news_num, self.max_title_length, self.entity_embedding_dim])                   # [batch_size * news_num, max_title_length, entity_embedding_dim]
-        context_embedding = self.context_embedding(title_entity).view([batch_size * news_num, self.max_title_length, self.context_embedding_dim])                # [batch_size * news_num, max_title_length, context_embedding_dim]
+        word_embedding = self.word_embedding(title_text).view([batch_size * news_num, -1, self.word_embedding_dim])                                              # [batch_size * news_num, max_title_length, word_embedding_dim]
+        entity_embedding = self.entity_embedding(title_entity).view([batch_size * news_num, -1, self.entity_embedding_dim])                                      # [batch_size * news_num, max_title_length, entity_embedding_dim]
+        context_embedding = self.context_embedding(title_entity).view([batch_size * news_num, -1, self.context_embedding_dim])                                   # [batch_size * news_num, max_title_length, context_embedding_dim]
         W = torch.stack([word_embedding, torch.tanh(self.M_entity(entity_embedding)), torch.tanh(self.M_context(context_embedding))], dim=3).permute(0, 2, 1, 3) # [batch_size * news_num, word_embedding_dim, max_title_length, 3]
         # 2. knowledge-aware CNN
         news_representation = self.knowledge_cnn(W).view([batch_size, news_num, self.cnn_kernel_num])                                                            # [batch_size, news_num, cnn_kernel_num]
@@ -240,12 +240,11 @@ class KCNN(NewsEncoder):
 class PCNN(NewsEncoder):
     def __init__(self, config: Config):
         super(PCNN, self).__init__(config)
-        self.max_title_length = config.max_title_length
-        self.max_content_length = config.max_abstract_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.news_embedding_dim = config.cnn_kernel_num * 2 + config.category_embedding_dim + config.subCategory_embedding_dim
         self.title_conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
         self.content_conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
+        self.variable_text_length = False # the max pooling over the title and abstract is not masked, the padded positions are pooled as well
 
     def initialize(self):
         super().initialize()
@@ -253,11 +252,11 @@ class PCNN(NewsEncoder):
     def forward(self, title_text, title_mask, title_entity, content_text, content_mask, content_entity, category, subCategory, user_embedding):
         batch_size = category.size(0)
         news_num = category.size(1)
-        title_mask = title_mask.view([batch_size * news_num, self.max_title_length])                                                                                 # [batch_size * news_num, max_title_length]
-        content_mask = content_mask.view([batch_size * news_num, self.max_content_length])                                                                           # [batch_size * news_num, max_content_length]
+        title_mask = title_mask.view([batch_size * news_num, -1])                                                                                                    # [batch_size * news_num, max_title_length]
+        content_mask = content_mask.view([batch_size * news_num, -1])                                                                                                # [batch_size * news_num, max_content_length]
         # 1. word embedding
-        title_w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, self.max_title_length, self.word_embedding_dim]).permute(0, 2, 1)       # [batch_size, news_num, max_title_length, word_embedding_dim]
-        content_w = self.dropout(self.word_embedding(content_text)).view([batch_size * news_num, self.max_content_length, self.word_embedding_dim]).permute(0, 2, 1) # [batch_size, news_num, max_content_length, word_embedding_dim]
+        title_w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, -1, self.word_embedding_dim]).permute(0, 2, 1)                          # [batch_size, news_num, max_title_length, word_embedding_dim]
+        content_w = self.dropout(self.word_embedding(content_text)).view([batch_size * news_num, -1, self.word_embedding_dim]).permute(0, 2, 1)                      # [batch_size, news_num, max_content_length, word_embedding_dim]
         # 2. CNN encoding
         title_c = self.dropout(self.title_conv(title_w).permute(0, 2, 1))                                                                                            # [batch_size * news_num, max_title_length, cnn_kernel_num]
         content_c = self.dropout(self.content_conv(content_w).permute(0, 2, 1))                                                                                      # [batch_size * news_num, max_content_length, cnn_kernel_num]
@@ -286,6 +285,8 @@ class HDC(NewsEncoder):
         self.layer_norm2 = nn.LayerNorm([self.HDC_filter_num, self.HDC_sequence_length])
         self.layer_norm3 = nn.LayerNorm([self.HDC_filter_num, self.HDC_sequence_length])
         self.news_embedding_dim = None
+        self.catalog_encodable = False # HDC outputs word-level feature maps for FIM, which are too large to be tabulated over the catalog
+        self.variable_text_length = False # the layer normalizations and the 3D convolution of FIM are sized by HDC_sequence_length
 
     def initialize(self):
         super().initialize()
@@ -311,8 +312,6 @@ class HDC(NewsEncoder):
 class NAML(NewsEncoder):
     def __init__(self, config: Config):
         super(NAML, self).__init__(config)
-        self.max_title_length = config.max_title_length
-        self.max_content_length = config.max_abstract_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.news_embedding_dim = config.cnn_kernel_num
         self.title_conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
@@ -323,6 +322,7 @@ class NAML(NewsEncoder):
         self.subCategory_affine = nn.Linear(in_features=config.subCategory_embedding_dim, out_features=config.cnn_kernel_num, bias=True)
         self.affine1 = nn.Linear(in_features=config.cnn_kernel_num, out_features=config.attention_dim, bias=True)
         self.affine2 = nn.Linear(in_features=config.attention_dim, out_features=1, bias=False)
+        self.variable_text_length = False # the title and abstract attentions are not masked, the padded positions are attended as well
 
     def initialize(self):
         super().initialize()
@@ -340,8 +340,8 @@ class NAML(NewsEncoder):
         batch_size = category.size(0)
         news_num = category.size(1)
         # 1. word embedding
-        title_w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, self.max_title_length, self.word_embedding_dim]).permute(0, 2, 1)       # [batch_size, news_num, max_title_length, word_embedding_dim]
-        content_w = self.dropout(self.word_embedding(content_text)).view([batch_size * news_num, self.max_content_length, self.word_embedding_dim]).permute(0, 2, 1) # [batch_size, news_num, max_content_length, word_embedding_dim]
+        title_w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, -1, self.word_embedding_dim]).permute(0, 2, 1)                          # [batch_size, news_num, max_title_length, word_embedding_dim]
+        content_w = self.dropout(self.word_embedding(content_text)).view([batch_size * news_num, -1, self.word_embedding_dim]).permute(0, 2, 1)                      # [batch_size, news_num, max_content_length, word_embedding_dim]
         # 2. CNN encoding
         title_c = self.dropout(self.title_conv(title_w).permute(0, 2, 1))                                                                                            # [batch_size * news_num, max_title_length, cnn_kernel_num]
         content_c = self.dropout(self.content_conv(content_w).permute(0, 2, 1))                                                                                      # [batch_size * news_num, max_content_length, cnn_kernel_num]
@@ -361,13 +361,14 @@ class NAML(NewsEncoder):
 class PNE(NewsEncoder):
     def __init__(self, config: Config):
         super(PNE, self).__init__(config)
-        self.max_sentence_length = config.max_title_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.personalized_embedding_dim = config.personalized_embedding_dim
         self.conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
         self.dense = nn.Linear(in_features=config.user_embedding_dim, out_features=config.personalized_embedding_dim, bias=True)
         self.personalizedAttention = CandidateAttention(config.cnn_kernel_num, config.personalized_embedding_dim, config.attention_dim)
         self.news_embedding_dim = config.cnn_kernel_num + config.category_embedding_dim + config.subCategory_embedding_dim
+        self.catalog_encodable = False # PNE news representations are personalized by the user embedding
+        self.variable_text_length = False # the convolution sees the trainable PAD word embedding beyond the last word, which trimming would replace by zero padding
 
     def initialize(self):
         super().initialize()
@@ -378,13 +379,13 @@ class PNE(NewsEncoder):
     def forward(self, title_text, title_mask, title_entity, content_text, content_mask, content_entity, category, subCategory, user_embedding):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
-        mask = title_mask.view([batch_size * news_num, self.max_sentence_length])                                                                           # [batch_size * news_num, max_sentence_length]
+        mask = title_mask.view([batch_size * news_num, -1])                                                                                                 # [batch_size * news_num, max_sentence_length]
         # 1. word embedding
-        w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, self.max_sentence_length, self.word_embedding_dim]).permute(0, 2, 1) # [batch_size * news_num, word_embedding_dim, max_sentence_length]
+        w = self.dropout(self.word_embedding(title_text)).view([batch_size * news_num, -1, self.word_embedding_dim]).permute(0, 2, 1)                       # [batch_size * news_num, word_embedding_dim, max_sentence_length]
         # 2. CNN encoding
         c = self.dropout(self.conv(w).permute(0, 2, 1))                                                                                                     # [batch_size * news_num, max_sentence_length, cnn_kernel_num]
         # 3. attention layer
-        q_w = F.relu(self.dense(user_embedding), inplace=True).repeat([news_num, 1])                                                                        # [batch_size * news_num, personalized_embedding_dim]
+        q_w = F.relu(self.dense(user_embedding), inplace=True).unsqueeze(dim=1).expand(-1, news_num, -1).reshape([batch_size * news_num, -1])               # [batch_size * news_num, personalized_embedding_dim]
         news_representation = self.personalizedAttention(c, q_w, mask).view([batch_size, news_num, self.cnn_kernel_num])                                    # [batch_size, news_num, cnn_kernel_num]
         # 4. feature fusion
         news_representation = self.feature_fusion(news_representation, category, subCategory)                                                               # [batch_size, news_num, news_embedding_dim]
@@ -1,18 +1,18 @@
 import os
 import shutil
-import platform
 import json
 from config import Config
 from MIND_corpus import MIND_Corpus
-from MIND_dataset import MIND_Train_Dataset
+from MIND_dataset import MIND_Train_Dataset, MIND_Train_Stream_Dataset, init_train_worker
 from util import get_run_index
 from util import compute_scores
+from util import Prefetcher
 from tqdm import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
 
 
 class Trainer:
@@ -24,8 +24,11 @@ class Trainer:
         self.negative_sample_num = config.negative_sample_num
         self.loss = self.negative_log_softmax if config.click_predictor in ['dot_product', 'mlp', 'FIM'] else self.negative_log_sigmoid
         self.optimizer = optim.Adam(filter(lambda p: p.requires_grad, self.model.parameters()), lr=config.lr, weight_decay=config.weight_decay)
+        self.config = config
+        self.device = torch.device(config.device)
         self.mind_corpus = mind_corpus
-        self.train_dataset = MIND_Train_Dataset(mind_corpus)
+        self.device_news_tables = config.device_news_tables
+        self.train_dataset = MIND_Train_Stream_Dataset(mind_corpus, config, self.device_news_tables) if config.train_stream else MIND_Train_Dataset(mind_corpus, self.device_news_tables, config.seed)
         self.run_index = get_run_index(model.model_name)
         if not os.path.exists('./models/' + model.model_name + '/#' + str(self.run_index)):
             os.mkdir('./models/' + model.model_name + '/#' + str(self.run_index))
@@ -62,36 +65,28 @@ class Trainer:
 
     def train(self):
         model = self.model
+        # batches are gathered by the dataset with on-the-fly negative sampling, the workers persist across epochs
+        if self.config.train_stream:
+            train_dataloader = DataLoader(self.train_dataset, batch_size=None, num_workers=self.config.num_workers, pin_memory=self.config.pin_memory, persistent_workers=self.config.num_workers > 0) # batches are streamed by the dataset
+        else:
+            train_dataloader = DataLoader(self.train_dataset, sampler=BatchSampler(RandomSampler(self.train_dataset), self.batch_size, drop_last=False), batch_size=None, num_workers=self.config.num_workers, pin_memory=self.config.pin_memory, \
+                                          worker_init_fn=init_train_worker, persistent_workers=self.config.num_workers > 0)
+        train_batches = Prefetcher(train_dataloader, self.device, self.config.prefetch_batch_num)
         for e in tqdm(range(self.epoch)):
-            self.train_dataset.negative_sampling()
-            train_dataloader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.batch_size // 8 if platform.system() == 'Linux' else 0, pin_memory=True)
             model.train()
             epoch_loss = 0
-            for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-                news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) in train_dataloader:
-                user_ID = user_ID.cuda(non_blocking=True)                                                                                                                       # [batch_size]
-                user_category = user_category.cuda(non_blocking=True)                                                                                                           # [batch_size, max_history_num]
-                user_subCategory = user_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, max_history_num]
-                user_title_text = user_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
-                user_title_mask = user_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
-                user_title_entity = user_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_title_length]
-                user_content_text = user_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
-                user_content_mask = user_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
-                user_content_entity = user_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, max_history_num, max_content_length]
-                user_history_mask = user_history_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num]
-                user_history_graph = user_history_graph.cuda(non_blocking=True)                                                                                                 # [batch_size, max_history_num, max_history_num]
-                user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)                                                                                 # [batch_size, category_num + 1]
-                user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)                                                                           # [batch_size, max_history_num]
-                news_category = news_category.cuda(non_blocking=True)                                                                                                           # [batch_size, 1 + negative_sample_num]
-                news_subCategory = news_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, 1 + negative_sample_num]
-                news_title_text = news_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
-                news_title_mask = news_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
-                news_title_entity = news_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_title_length]
-                news_content_text = news_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
-                news_content_mask = news_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
-                news_content_entity = news_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, 1 + negative_sample_num, max_content_length]
+            epoch_sample_num = 0
+            for batch in train_batches:
+                if self.device_news_tables:
+                    # index-only batch, the news features are gathered from the device-resident news tables of the model
+                    (user_ID, user_history_index, user_history_mask, user_history_category_mask, user_history_category_indices, news_index) = batch
+                    user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity = model.gather_news(user_history_index)
+                    news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity = model.gather_news(news_index)
+                else:
+                    (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
+                     news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) = batch
 
-                logits = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                logits = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
                                news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) # [batch_size, 1 + negative_sample_num]
 
                 loss = self.loss(logits)
@@ -102,16 +97,18 @@ class Trainer:
                     user_encoder_auxiliary_loss = model.user_encoder.auxiliary_loss.mean()
                     loss += user_encoder_auxiliary_loss
                 epoch_loss += float(loss) * user_ID.size(0)
+                epoch_sample_num += user_ID.size(0)
                 self.optimizer.zero_grad()
                 loss.backward()
                 if self.gradient_clip_norm > 0:
                     nn.utils.clip_grad_norm_(model.parameters(), self.gradient_clip_norm)
                 self.optimizer.step()
             print('Epoch %d : train done' % (e + 1))
-            print('loss =', epoch_loss / len(self.train_dataset))
+            train_batches.report('Epoch %d train' % (e + 1))
+            print('loss =', epoch_loss / max(epoch_sample_num, 1)) # the stream dataset drops the remainder samples
 
             # validation
-            auc, mrr, ndcg, ndcg10 = compute_scores(model, self.mind_corpus, self.batch_size, 'dev', './dev/res/' + model.model_name + '/#' + str(self.run_index) + '/' + model.model_name + '-' + str(e + 1) + '.txt')
+            auc, mrr, ndcg, ndcg10 = compute_scores(model, self.mind_corpus, self.config, 'dev', './dev/res/' + model.model_name + '/#' + str(self.run_index) + '/' + model.model_name + '-' + str(e + 1) + '.txt')
             self.auc.append(auc)
             self.mrr.append(mrr)
             self.ndcg.append(ndcg)
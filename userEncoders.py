@@ -5,11 +5,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence
-from layers import MultiHeadAttention, Attention, ScaledDotProduct_CandidateAttention, CandidateAttention, GCN
+from layers import MultiHeadAttention, Attention, ScaledDotProduct_CandidateAttention, CandidateAttention, GCN, HistoryGraph
 from newsEncoders import NewsEncoder, HDC
 from util import try_to_install_torch_scatter_package
 try_to_install_torch_scatter_package()
-from torch_scatter import scatter_add, scatter_softmax # need to be installed by following `https://pytorch-scatter.readthedocs.io/en/latest`
+from torch_scatter import scatter_softmax # need to be installed by following `https://pytorch-scatter.readthedocs.io/en/latest`
 
 
 class UserEncoder(nn.Module):
@@ -17,30 +17,45 @@ class UserEncoder(nn.Module):
         super(UserEncoder, self).__init__()
         self.news_embedding_dim = news_encoder.news_embedding_dim
         self.news_encoder = news_encoder
-        self.device = torch.device('cuda')
+        self.device = torch.device(config.device)
         self.auxiliary_loss = None
 
     # Input
     # user_ID                       : [batch_size]
-    # user_title_text               : [batch_size, max_history_num, max_title_length]
-    # user_title_mask               : [batch_size, max_history_num, max_title_length]
-    # user_title_entity             : [batch_size, max_history_num, max_title_length]
-    # user_content_text             : [batch_size, max_history_num, max_content_length]
-    # user_content_mask             : [batch_size, max_history_num, max_content_length]
-    # user_content_entity           : [batch_size, max_history_num, max_content_length]
-    # user_category                 : [batch_size, max_history_num]
-    # user_subCategory              : [batch_size, max_history_num]
+    # history_embedding             : [batch_size, max_history_num, news_embedding_dim] (output of news_encoder on the user history)
     # user_history_mask             : [batch_size, max_history_num]
-    # user_history_graph            : [batch_size, max_history_num, max_history_num]
     # user_history_category_mask    : [batch_size, category_num]
     # user_history_category_indices : [batch_size, max_history_num]
     # user_embedding                : [batch_size, user_embedding]
     # candidate_news_representaion  : [batch_size, news_num, news_embedding_dim]
     # Output
-    # user_representation           : [batch_size, news_embedding_dim]
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
-        raise Exception('Function forward must be implemented at sub-class')
+    # user_representation           : [batch_size, news_num, news_embedding_dim]
+    def forward(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
+        user_state = self.prepare(user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding)
+        return self.score(user_state, candidate_news_representaion)
+
+    # Candidate-independent phase, run once per user
+    # Input
+    # the same as forward, without candidate_news_representaion
+    # Output
+    # user_state                    : tuple of tensors with batch_size as the first dimension, which can be reused for any number of candidate news
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
+        raise Exception('Function prepare must be implemented at sub-class')
+
+    # Candidate-dependent phase, by default the user representation does not depend on the candidate news
+    # Input
+    # user_state                    : output of prepare
+    # candidate_news_representaion  : [batch_size, news_num, news_embedding_dim]
+    # Output
+    # user_representation           : [batch_size, news_num, news_embedding_dim]
+    def score(self, user_state, candidate_news_representaion):
+        news_num = candidate_news_representaion.size(1)
+        user_representation = user_state[0].unsqueeze(dim=1).expand(-1, news_num, -1) # [batch_size, news_num, news_embedding_dim]
+        return user_representation
+
+    # Number of float elements allocated by score (including the candidate news representation) per (user, candidate) pair, used to bound the candidate chunk size in evaluation
+    def candidate_memory_size(self):
+        return self.news_embedding_dim * 2
 
 
 class SUE(UserEncoder):
@@ -49,6 +64,7 @@ class SUE(UserEncoder):
         self.attention_dim = max(config.attention_dim, self.news_embedding_dim // 4)
         self.proxy_node_embedding = nn.Parameter(torch.zeros([config.category_num, self.news_embedding_dim], device=self.device))
         self.gcn = GCN(in_dim=self.news_embedding_dim, out_dim=self.news_embedding_dim, hidden_dim=self.news_embedding_dim, num_layers=config.gcn_layer_num, dropout=config.dropout_rate / 2, residual=not config.no_gcn_residual, layer_norm=config.gcn_layer_norm)
+        self.history_graph = HistoryGraph(config.max_history_num, config.category_num, self_connection=not config.no_self_connection, normalization_type=None if config.no_adjacent_normalization else config.gcn_normalization_type)
         self.intraCluster_K = nn.Linear(in_features=self.news_embedding_dim, out_features=self.attention_dim, bias=True)
         self.intraCluster_Q = nn.Linear(in_features=self.news_embedding_dim, out_features=self.attention_dim, bias=True)
         self.clusterFeatureAffine = nn.Linear(in_features=self.news_embedding_dim, out_features=self.news_embedding_dim, bias=True)
@@ -70,38 +86,42 @@ class SUE(UserEncoder):
         nn.init.zeros_(self.clusterFeatureAffine.bias)
         self.interClusterAttention.initialize()
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
         batch_size = user_ID.size(0)
-        news_num = candidate_news_representaion.size(1)
-        user_history_category_mask = user_history_category_mask.unsqueeze(dim=1).expand(-1, news_num, -1).contiguous()                                  # [batch_size, news_num, category_num]
-        user_history_category_mask[:, :, -1] = 1.0
-        user_history_category_indices = user_history_category_indices.unsqueeze(dim=1).expand(-1, news_num, -1)                                         # [batch_size, news_num, max_history_num]
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                          # [batch_size, max_history_num, news_embedding_dim]
+        user_history_category_mask = user_history_category_mask.clone()                                                                                # [batch_size, category_num]
+        user_history_category_mask[:, -1] = 1.0
+        user_history_category_one_hot = F.one_hot(user_history_category_indices, self.category_num).to(history_embedding.dtype)                         # [batch_size, max_history_num, category_num]
         # 1. GCN
         history_embedding = torch.cat([history_embedding, self.dropout_(self.proxy_node_embedding.unsqueeze(dim=0).expand(batch_size, -1, -1))], dim=1) # [batch_size, max_history_num + category_num, news_embedding_dim]
-        gcn_feature = self.gcn(history_embedding, user_history_graph) + history_embedding                                                               # [batch_size, max_history_num + category_num, news_embedding_dim]
+        gcn_feature = self.gcn(history_embedding, self.history_graph(user_history_category_indices, history_embedding.dtype)) + history_embedding                                                               # [batch_size, max_history_num + category_num, news_embedding_dim]
         gcn_feature = gcn_feature[:, :self.max_history_num, :]                                                                                          # [batch_size, max_history_num, news_embedding_dim]
-        gcn_feature = gcn_feature.unsqueeze(dim=1).expand(-1, news_num, -1, -1)                                                                         # [batch_size, news_num, max_history_num, news_embedding_dim]
+        K = self.intraCluster_K(gcn_feature)                                                                                                            # [batch_size, max_history_num, attention_dim]
+        return gcn_feature, K, user_history_category_mask, user_history_category_indices, user_history_category_one_hot
+
+    def score(self, user_state, candidate_news_representaion):
+        gcn_feature, K, user_history_category_mask, user_history_category_indices, user_history_category_one_hot = user_state
+        batch_size = gcn_feature.size(0)
+        news_num = candidate_news_representaion.size(1)
         # 2. Intra-cluster attention
-        K = self.intraCluster_K(gcn_feature).view([batch_size * news_num, self.max_history_num, self.attention_dim])                                    # [batch_size * news_num, max_history_num, attention_dim]
-        Q = self.intraCluster_Q(candidate_news_representaion).view([batch_size * news_num, self.attention_dim, 1])                                      # [batch_size * news_num, attention_dim]
-        a = torch.bmm(K, Q).view([batch_size, news_num, self.max_history_num]) / self.attention_scalar                                                  # [batch_size, news_num, max_history_num]
-        alpha_intra = scatter_softmax(a, user_history_category_indices, 2).unsqueeze(dim=3)                                                             # [batch_size, news_num, max_history_num, 1]
-        intra_cluster_feature = torch.zeros([batch_size, news_num, self.category_num, self.news_embedding_dim], device=self.device)                     # [batch_size, news_num, category_num, news_embedding_dim]
-        intra_cluster_feature = scatter_add(alpha_intra * gcn_feature, user_history_category_indices, dim=2, out=intra_cluster_feature)                 # [batch_size, news_num, category_num, news_embedding_dim]
+        Q = self.intraCluster_Q(candidate_news_representaion)                                                                                           # [batch_size, news_num, attention_dim]
+        a = torch.bmm(Q, K.permute(0, 2, 1)) / self.attention_scalar                                                                                    # [batch_size, news_num, max_history_num]
+        alpha_intra = scatter_softmax(a, user_history_category_indices.unsqueeze(dim=1).expand(-1, news_num, -1), 2)                                    # [batch_size, news_num, max_history_num]
+        # aggregate the history news of each category cluster without materializing the per-candidate history features
+        cluster_weights = (alpha_intra.unsqueeze(dim=3) * user_history_category_one_hot.unsqueeze(dim=1)).permute(0, 1, 3, 2)                           # [batch_size, news_num, category_num, max_history_num]
+        intra_cluster_feature = torch.matmul(cluster_weights, gcn_feature.unsqueeze(dim=1))                                                             # [batch_size, news_num, category_num, news_embedding_dim]
         # perform nonlinear transformation on intra-cluster features
         intra_cluster_feature = self.dropout(F.relu(self.clusterFeatureAffine(intra_cluster_feature), inplace=True) + intra_cluster_feature)            # [batch_size, news_num, category_num, news_embedding_dim]
         # 3. Inter-cluster attention
         inter_cluster_feature = self.interClusterAttention(
             intra_cluster_feature.view([batch_size * news_num, self.category_num, self.news_embedding_dim]),
-            candidate_news_representaion.view([batch_size * news_num, self.news_embedding_dim]),
-            mask=user_history_category_mask.view([batch_size * news_num, self.category_num])
+            candidate_news_representaion.reshape([batch_size * news_num, self.news_embedding_dim]),
+            mask=user_history_category_mask.unsqueeze(dim=1).expand(-1, news_num, -1).reshape([batch_size * news_num, self.category_num])
         ).view([batch_size, news_num, self.news_embedding_dim])                                                                                         # [batch_size, news_num, news_embedding_dim]
         return inter_cluster_feature
 
+    def candidate_memory_size(self):
+        return self.attention_dim * (self.category_num + 1) + self.max_history_num * (self.category_num + 4) + self.news_embedding_dim * (self.category_num * 3 + 2)
+
 
 class LSTUR(UserEncoder):
     def __init__(self, news_encoder: NewsEncoder, config: Config):
@@ -116,20 +136,14 @@ class LSTUR(UserEncoder):
             else:
                 nn.init.zeros_(parameter.data)
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
         batch_size = user_ID.size(0)
         user_history_num = user_history_mask.sum(dim=1, keepdim=False).long()                                                                           # [batch_size]
-        news_num = candidate_news_representaion.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                          # [batch_size, max_history_num, news_embedding_dim]
         sorted_user_history_num, sorted_indices = torch.sort(user_history_num, descending=True)                                                         # [batch_size]
         _, desorted_indices = torch.sort(sorted_indices, descending=False)                                                                              # [batch_size]
         nonzero_indices = sorted_user_history_num.nonzero(as_tuple=False).squeeze(dim=1)
         if nonzero_indices.size(0) == 0:
-            user_representation = user_embedding.unsqueeze(dim=1).expand(-1, news_num, -1)                                                              # [batch_size, news_num, news_embedding_dim]  
-            return user_representation
+            return (user_embedding, )
         index = nonzero_indices[-1]
         if index + 1 == batch_size:
             sorted_user_embedding = user_embedding.index_select(0, sorted_indices)                                                                      # [batch_size, user_embedding_dim]
@@ -149,8 +163,7 @@ class LSTUR(UserEncoder):
             packed_sorted_history_embedding = pack_padded_sequence(sorted_history_embedding, sorted_user_history_num[:index+1].cpu(), batch_first=True) # [batch_size, max_history_num, news_embedding_dim]
             _, h = self.gru(packed_sorted_history_embedding, sorted_user_embedding.unsqueeze(dim=0))                                                    # [1, batch_size, news_embedding_dim]
             user_representation = torch.cat([h.squeeze(dim=0), user_embedding.index_select(0, empty_indices)], dim=0).index_select(0, desorted_indices) # [batch_size, news_embedding_dim]
-        user_representation = user_representation.unsqueeze(dim=1).expand(-1, news_num, -1)                                                             # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        return (user_representation, )
 
 
 class MHSA(UserEncoder):
@@ -166,17 +179,11 @@ class MHSA(UserEncoder):
         nn.init.zeros_(self.affine.bias)
         self.attention.initialize()
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
-        batch_size = user_ID.size(0)
-        news_num = candidate_news_representaion.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                  # [batch_size, max_history_num, news_embedding_dim]
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
         h = self.multiheadAttention(history_embedding, history_embedding, history_embedding, user_history_mask) # [batch_size, max_history_num, head_num * head_dim]
         h = F.relu(F.dropout(self.affine(h), training=self.training, inplace=True), inplace=True)               # [batch_size, max_history_num, news_embedding_dim]
-        user_representation = self.attention(h).unsqueeze(dim=1).repeat(1, news_num, 1)                         # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        user_representation = self.attention(h)                                                                 # [batch_size, news_embedding_dim]
+        return (user_representation, )
 
 
 class ATT(UserEncoder):
@@ -187,14 +194,9 @@ class ATT(UserEncoder):
     def initialize(self):
         self.attention.initialize()
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
-        news_num = candidate_news_representaion.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)            # [batch_size, max_history_num, news_embedding_dim]
-        user_representation = self.attention(history_embedding).unsqueeze(dim=1).expand(-1, news_num, -1) # [batch_size, news_embedding_dim]
-        return user_representation
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
+        user_representation = self.attention(history_embedding) # [batch_size, news_embedding_dim]
+        return (user_representation, )
 
 
 class CATT(UserEncoder):
@@ -210,22 +212,24 @@ class CATT(UserEncoder):
         nn.init.xavier_uniform_(self.affine2.weight)
         nn.init.zeros_(self.affine2.bias)
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
-        news_num = candidate_news_representaion.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                # [batch_size, max_history_num, news_embedding_dim]
-        user_history_mask = user_history_mask.unsqueeze(dim=1).expand(-1, news_num, -1)                                       # [batch_size, news_num, max_history_num]
-        candidate_news_representaion = candidate_news_representaion.unsqueeze(dim=2).expand(-1, -1, self.max_history_num, -1) # [batch_size, news_num, max_history_num, news_embedding_dim]
-        history_embedding = history_embedding.unsqueeze(dim=1).expand(-1, news_num, -1, -1)                                   # [batch_size, news_num, max_history_num, news_embedding_dim]
-        concat_embeddings = torch.cat([candidate_news_representaion, history_embedding], dim=3)                               # [batch_size, news_num, max_history_num, news_embedding_dim * 2]
-        hidden = F.relu(self.affine1(concat_embeddings), inplace=True)                                                        # [batch_size, news_num, max_history_num, attention_dim]
-        a = self.affine2(hidden).squeeze(dim=3)                                                                               # [batch_size, news_num, max_history_num]
-        alpha = F.softmax(a.masked_fill(user_history_mask == 0, -1e9), dim=2)                                                 # [batch_size, news_num, max_history_num]
-        user_representation = (alpha.unsqueeze(dim=3) * history_embedding).sum(dim=2, keepdim=False)                          # [batch_size, news_num, news_embedding_dim]
+    # affine1 works on the concatenation [candidate, history], its history half is computed once per user
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
+        history_hidden = F.linear(history_embedding, self.affine1.weight[:, self.news_embedding_dim:], self.affine1.bias) # [batch_size, max_history_num, attention_dim]
+        return history_embedding, history_hidden, user_history_mask
+
+    def score(self, user_state, candidate_news_representaion):
+        history_embedding, history_hidden, user_history_mask = user_state
+        candidate_hidden = F.linear(candidate_news_representaion, self.affine1.weight[:, :self.news_embedding_dim])      # [batch_size, news_num, attention_dim]
+        hidden = F.relu(candidate_hidden.unsqueeze(dim=2) + history_hidden.unsqueeze(dim=1), inplace=True)              # [batch_size, news_num, max_history_num, attention_dim]
+        a = self.affine2(hidden).squeeze(dim=3)                                                                         # [batch_size, news_num, max_history_num]
+        alpha = F.softmax(a.masked_fill(user_history_mask.unsqueeze(dim=1) == 0, -1e9), dim=2)                          # [batch_size, news_num, max_history_num]
+        user_representation = torch.bmm(alpha, history_embedding)                                                       # [batch_size, news_num, news_embedding_dim]
         return user_representation
 
+    def candidate_memory_size(self):
+        return self.max_history_num * (self.affine1.out_features + 3) + self.affine1.out_features + self.news_embedding_dim * 2
+
+
 
 class FIM(UserEncoder):
     def __init__(self, news_encoder: NewsEncoder, config: Config):
@@ -237,16 +241,19 @@ class FIM(UserEncoder):
         self.conv_3D_a = nn.Conv3d(in_channels=4, out_channels=config.conv3D_filter_num_first, kernel_size=config.conv3D_kernel_size_first)
         self.conv_3D_b = nn.Conv3d(in_channels=config.conv3D_filter_num_first, out_channels=config.conv3D_filter_num_second, kernel_size=config.conv3D_kernel_size_second)
         self.maxpool_3D = torch.nn.MaxPool3d(kernel_size=config.maxpooling3D_size, stride=config.maxpooling3D_stride)
+        self.conv3D_filter_num_first = config.conv3D_filter_num_first
+        self.conv3D_filter_num_second = config.conv3D_filter_num_second
 
     def initialize(self):
         pass
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
+        history_embedding_d0, history_embedding_dL = history_embedding # [batch_size, max_history_num, HDC_filter_num, HDC_sequence_length], [batch_size, max_history_num, 3, HDC_filter_num, HDC_sequence_length]
+        return history_embedding_d0, history_embedding_dL
+
+    def score(self, user_state, candidate_news_representaion):
+        history_embedding_d0, history_embedding_dL = user_state
         candidate_news_d0, candidate_news_dL = candidate_news_representaion
-        history_embedding_d0, history_embedding_dL = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                                                       user_content_text, user_content_mask, user_content_entity, \
-                                                                       user_category, user_subCategory, user_embedding)
         batch_size = candidate_news_d0.size(0)
         news_num = candidate_news_d0.size(1)
         # 1. compute 3D matching images
@@ -266,6 +273,11 @@ class FIM(UserEncoder):
         salient_signals = Q2.view([batch_size, news_num, -1])                                                                   # [batch_size * news_num, feature_size]
         return salient_signals
 
+    # the matching images and the 3D convolution outputs dominate, which are bounded by [channel_num, max_history_num, HDC_sequence_length, HDC_sequence_length]
+    def candidate_memory_size(self):
+        return (8 + self.conv3D_filter_num_first + self.conv3D_filter_num_second) * self.max_history_num * self.HDC_sequence_length * self.HDC_sequence_length
+
+
 
 class ARNN(UserEncoder):
     def __init__(self, news_encoder: NewsEncoder, config: Config):
@@ -293,16 +305,10 @@ class ARNN(UserEncoder):
             for j in range(i):
                 for k in range(1, j + 1):
                     lower_triangle_matrices[i, j, k] = 1
-        self.lower_triangle_matrices = torch.from_numpy(lower_triangle_matrices).cuda()
+        self.lower_triangle_matrices = torch.from_numpy(lower_triangle_matrices).to(self.device)
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
-        batch_size = user_ID.size(0)
-        news_num = candidate_news_representaion.size(1)
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
         user_history_num = user_history_mask.sum(dim=1, keepdim=False).long()                                  # [batch_size]
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                 # [batch_size, max_history_num, news_embedding_dim]
         h, (h_n, c_n) = self.lstm(history_embedding)                                                           # [batch_size, max_history_num, news_embedding_dim]
         h1 = torch.tanh(self.w1(h))                                                                            # [batch_size, max_history_num, attention_dim]
         h2 = torch.tanh(self.w2(h))                                                                            # [batch_size, max_history_num, attention_dim]
@@ -310,8 +316,8 @@ class ARNN(UserEncoder):
         s = torch.cumsum(e, dim=1)                                                                             # [batch_size, max_history_num, max_history_num]
         mask = torch.index_select(self.lower_triangle_matrices, 0, user_history_num)                           # [batch_size, max_history_num, max_history_num]
         alpha = e / s * mask                                                                                   # [batch_size, max_history_num, max_history_num]
-        user_representation = torch.bmm(alpha, h).sum(dim=1, keepdim=True).repeat(1, news_num, 1)              # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        user_representation = torch.bmm(alpha, h).sum(dim=1, keepdim=False)                                   # [batch_size, news_embedding_dim]
+        return (user_representation, )
 
 
 class PUE(UserEncoder):
@@ -325,15 +331,10 @@ class PUE(UserEncoder):
         nn.init.zeros_(self.dense.bias)
         self.personalizedAttention.initialize()
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
-        news_num = candidate_news_representaion.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                # [batch_size, max_history_num, news_embedding_dim]
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
         q_d = F.relu(self.dense(user_embedding), inplace=True)                                                                                # [batch_size, personalized_embedding_dim]
-        user_representation = self.personalizedAttention(history_embedding, q_d, user_history_mask).unsqueeze(dim=1).expand(-1, news_num, -1) # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        user_representation = self.personalizedAttention(history_embedding, q_d, user_history_mask) # [batch_size, news_embedding_dim]
+        return (user_representation, )
 
 
 class GRU(UserEncoder):
@@ -351,20 +352,15 @@ class GRU(UserEncoder):
         nn.init.xavier_uniform_(self.dec.weight, gain=nn.init.calculate_gain('tanh'))
         nn.init.zeros_(self.dec.bias)
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
         batch_size = user_ID.size(0)
         user_history_num = user_history_mask.sum(dim=1, keepdim=False).long()                                                                           # [batch_size]
-        news_num = candidate_news_representaion.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                          # [batch_size, max_history_num, news_embedding_dim]
         sorted_user_history_num, sorted_indices = torch.sort(user_history_num, descending=True)                                                         # [batch_size]
         _, desorted_indices = torch.sort(sorted_indices, descending=False)                                                                              # [batch_size]
         nonzero_indices = sorted_user_history_num.nonzero(as_tuple=False).squeeze(dim=1)
         if nonzero_indices.size(0) == 0:
-            user_representation = torch.zeros([batch_size, news_num, self.news_embedding_dim], device=self.device)                                      # [batch_size, news_num, news_embedding_dim]
-            return user_representation
+            user_representation = torch.zeros([batch_size, self.news_embedding_dim], device=self.device)                                                # [batch_size, news_embedding_dim]
+            return (user_representation, )
         index = nonzero_indices[-1]
         if index + 1 == batch_size:
             sorted_history_embedding = history_embedding.index_select(0, sorted_indices)                                                                # [batch_size, max_history_num, news_embedding_dim]
@@ -380,8 +376,7 @@ class GRU(UserEncoder):
             h = torch.tanh(self.dec(h.squeeze(dim=0)))                                                                                                  # [batch_size, news_embedding_dim]
             user_representation = torch.cat([h, torch.zeros([batch_size - 1 - index, self.news_embedding_dim], device=self.device)], \
                                             dim=0).index_select(0, desorted_indices)                                                                    # [batch_size, news_embedding_dim]
-        user_representation = user_representation.unsqueeze(dim=1).expand(-1, news_num, -1)                                                             # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        return (user_representation, )
 
 
 class OMAP(UserEncoder):
@@ -398,11 +393,7 @@ class OMAP(UserEncoder):
     def initialize(self):
         nn.init.orthogonal_(self.W.data)
 
-    def forward(self, user_ID, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representaion):
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)       # [batch_size, max_history_num, news_embedding_dim]
+    def prepare(self, user_ID, history_embedding, user_history_mask, user_history_category_mask, user_history_category_indices, user_embedding):
         # 1. self-attention
         a = torch.bmm(history_embedding, history_embedding.permute(0, 2, 1)) / self.scalar           # [batch_size, max_history_num, max_history_num]
         mask = user_history_mask.unsqueeze(dim=1).expand(-1, self.max_history_num, -1)               # [batch_size, max_history_num, max_history_num]
@@ -413,13 +404,20 @@ class OMAP(UserEncoder):
         mask = user_history_mask.unsqueeze(dim=2).expand(-1, -1, self.OMAP_head_num)                 # [batch_size, max_history_num, OMAP_head_num]
         beta = F.softmax(b.masked_fill(mask == 0, -1e9), dim=2)                                      # [batch_size, max_history_num, OMAP_head_num]
         archives = torch.bmm(beta.permute(0, 2, 1), history_embedding)                               # [batch_size, OMAP_head_num, news_embedding_dim]
-        # 3. aggregate archives into user representation
-        betatheta = torch.bmm(candidate_news_representaion, archives.permute(0, 2, 1)) / self.scalar # [batch_size, news_num, OMAP_head_num]
-        archive_weights = F.softmax(betatheta, dim=2)                                                # [batch_size, news_num, OMAP_head_num]
-        user_representation = torch.bmm(archive_weights, archives)                                   # [batch_size, news_num, news_embedding_dim]
-        # 4. auxiliary loss to regularize the pooling heads \Lambda
+        # 3. auxiliary loss to regularize the pooling heads \Lambda
         # To minimize the term \Omega = ||\Lambda^{T}\Lambda \odot (J_{k}-I_{k})||_{F} in Hi-Fi Ark
         if self.training:
             Omega = torch.norm(torch.mm(self.W.transpose(1, 0), self.W) * (self.J_k - self.I_k), p='fro')
             self.auxiliary_loss = self.HiFi_Ark_regularizer_coefficient * Omega
+        return (archives, )
+
+    def score(self, user_state, candidate_news_representaion):
+        archives = user_state[0]                                                                     # [batch_size, OMAP_head_num, news_embedding_dim]
+        # 4. aggregate archives into user representation
+        betatheta = torch.bmm(candidate_news_representaion, archives.permute(0, 2, 1)) / self.scalar # [batch_size, news_num, OMAP_head_num]
+        archive_weights = F.softmax(betatheta, dim=2)                                                # [batch_size, news_num, OMAP_head_num]
+        user_representation = torch.bmm(archive_weights, archives)                                   # [batch_size, news_num, news_embedding_dim]
         return user_representation
+
+    def candidate_memory_size(self):
+        return self.OMAP_head_num * 2 + self.news_embedding_dim * 2
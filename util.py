@@ -1,72 +1,327 @@
 import os
-import platform
+import queue
+import threading
+import time
+import numpy as np
 from config import Config
 import torch
 import torch.nn as nn
-from MIND_corpus import MIND_Corpus
-from MIND_dataset import MIND_DevTest_Dataset
-from torch.utils.data import DataLoader
-from evaluate import scoring
+from MIND_corpus import MIND_Corpus, MIND_Behaviors
+from MIND_dataset import MIND_DevTest_Dataset, MIND_DevTest_Impression_Dataset, MIND_DevTest_Catalog_Dataset
+import torch.utils.data as data
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
+from evaluate import impression_offsets, scoring_arrays
 
 
-def compute_scores(model: nn.Module, mind_corpus: MIND_Corpus, batch_size: int, mode: str, result_file: str):
-    assert mode in ['dev', 'test'], 'mode must be choosen from \'dev\' or \'test\''
-    dataset = MIND_DevTest_Dataset(mind_corpus, mode)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=batch_size // 8 if platform.system() == 'Linux' else 0, pin_memory=True)
-    indices = (mind_corpus.dev_indices if mode == 'dev' else mind_corpus.test_indices)
-    scores = torch.zeros([len(indices)]).cuda()
+# Run the news encoder once over the whole news catalog, the chunk size matches the news number encoded in a training step
+def compute_news_table(model: nn.Module, mind_corpus: MIND_Corpus, config: Config):
+    device = torch.device(config.device)
+    news_num = mind_corpus.news_title_text.shape[0]
+    chunk_size = config.batch_size * mind_corpus.max_history_num
+    news_table = torch.zeros([news_num, model.news_embedding_dim], device=device)
+    with torch.no_grad():
+        for i in range(0, news_num, chunk_size):
+            j = min(i + chunk_size, news_num)
+            # copied rather than wrapped by torch.from_numpy, as some news encoders fill the masks in place which would modify the corpus on CPU
+            news_category = torch.tensor(mind_corpus.news_category[i: j], device=device).unsqueeze(dim=0)                 # [1, chunk_size]
+            news_subCategory = torch.tensor(mind_corpus.news_subCategory[i: j], device=device).unsqueeze(dim=0)           # [1, chunk_size]
+            news_title_text = torch.tensor(mind_corpus.news_title_text[i: j], device=device).unsqueeze(dim=0)             # [1, chunk_size, max_title_length]
+            news_title_mask = torch.tensor(mind_corpus.news_title_mask[i: j], device=device).unsqueeze(dim=0)             # [1, chunk_size, max_title_length]
+            news_title_entity = torch.tensor(mind_corpus.news_title_entity[i: j], device=device).unsqueeze(dim=0)         # [1, chunk_size, max_title_length]
+            news_abstract_text = torch.tensor(mind_corpus.news_abstract_text[i: j], device=device).unsqueeze(dim=0)       # [1, chunk_size, max_abstract_length]
+            news_abstract_mask = torch.tensor(mind_corpus.news_abstract_mask[i: j], device=device).unsqueeze(dim=0)       # [1, chunk_size, max_abstract_length]
+            news_abstract_entity = torch.tensor(mind_corpus.news_abstract_entity[i: j], device=device).unsqueeze(dim=0)   # [1, chunk_size, max_abstract_length]
+            news_table[i: j] = model.encode_news(news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity, news_category, news_subCategory, None).squeeze(dim=0) # [chunk_size, news_embedding_dim]
+    return news_table
+
+
+# Wait for the queued kernels of the device, so that wall-clock timings are accurate
+def synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+# Iterate the batches of a DataLoader with the tensors already on the device, the next batch_num batches are assembled and transferred on a background thread while the current batch is computed
+# On GPU the transfers run on a side CUDA stream, the current stream waits for the transfer of a batch before using it
+class Prefetcher:
+    def __init__(self, dataloader: DataLoader, device: torch.device, batch_num: int):
+        self.dataloader = dataloader
+        self.device = device
+        self.batch_num = batch_num
+        self.fetch_num = 0
+        self.queue_depth = 0   # sum of the queue depths seen when a batch is requested
+        self.stall_time = 0    # time waited for the batches of the queue
+
+    def transfer(self, batch):
+        return tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+
+    def load(self, batch_queue: queue.Queue):
+        try:
+            stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+            for batch in self.dataloader:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self.transfer(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    batch_queue.put((batch, event))
+                else:
+                    batch_queue.put((self.transfer(batch), None))
+            batch_queue.put(None)
+        except Exception as e:
+            batch_queue.put(e)
+
+    def __iter__(self):
+        if self.batch_num <= 0:
+            batches = iter(self.dataloader)
+            while True:
+                start_time = time.time()
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                batch = self.transfer(batch)
+                self.stall_time += time.time() - start_time
+                self.fetch_num += 1
+                yield batch
+        batch_queue = queue.Queue(maxsize=self.batch_num)
+        threading.Thread(target=self.load, args=(batch_queue, ), daemon=True).start()
+        while True:
+            self.queue_depth += batch_queue.qsize()
+            start_time = time.time()
+            item = batch_queue.get()
+            self.stall_time += time.time() - start_time
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            batch, event = item
+            if event is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(event)
+                for tensor in batch:
+                    tensor.record_stream(current_stream) # the memory allocated on the side stream is not reused before the current stream is done with it
+            self.fetch_num += 1
+            yield batch
+
+    # Report the input pipeline of the last passes and reset the counters, a long stall time with an empty queue means the computation is input-bound
+    def report(self, name: str):
+        print('%s prefetch : %d batches, average queue depth %.2f / %d, stall time %.2fs' % (name, self.fetch_num, self.queue_depth / max(self.fetch_num, 1), self.batch_num, self.stall_time))
+        self.fetch_num = 0
+        self.queue_depth = 0
+        self.stall_time = 0
+
+
+# Candidate chunk size of the scoring step, so that the memory allocated per chunk, [batch_size, chunk_size, candidate_memory_size] float elements, stays within config.eval_memory_budget
+def get_candidate_chunk_size(model: nn.Module, config: Config, batch_size: int, candidate_num: int):
+    if config.eval_memory_budget <= 0:
+        return candidate_num
+    budget = config.eval_memory_budget * 1024 * 1024 // 4 # float32 elements
+    return max(1, min(candidate_num, budget // (batch_size * model.user_encoder.candidate_memory_size())))
+
+
+def get_eval_mode(model: nn.Module, config: Config):
+    if config.eval_mode == 'catalog' and not model.news_encoder.catalog_encodable:
+        return 'impression'
+    return config.eval_mode
+
+
+# With index_only (--device_news_tables), the batches carry news indices instead of news features, the impression mode then shares the index batches of the catalog mode
+def get_eval_dataset(mind_corpus: MIND_Corpus, eval_mode: str, mode: str, behaviors: MIND_Behaviors = None, index_only: bool = False):
+    if eval_mode == 'catalog' or (eval_mode == 'impression' and index_only):
+        return MIND_DevTest_Catalog_Dataset(mind_corpus, mode, behaviors)
+    elif eval_mode == 'impression':
+        return MIND_DevTest_Impression_Dataset(mind_corpus, mode, behaviors)
+    else:
+        return MIND_DevTest_Dataset(mind_corpus, mode, behaviors, index_only)
+
+
+# Score the candidates of an evaluation dataset, news_table is the news representation table of the catalog mode
+# Output
+# scores             : [candidate_num] (in the order of dataset.behaviors)
+# user_encoding_num  : number of encoded users (catalog & impression modes)
+# user_encoding_time : time used by the user encoding (catalog & impression modes)
+def score_dataset(model: nn.Module, config: Config, dataset: data.Dataset, eval_mode: str, news_table: torch.Tensor = None):
+    batch_size = config.batch_size
+    if eval_mode != 'pair':
+        dataloader = DataLoader(dataset, batch_sampler=dataset.user_grouped_batches(batch_size), num_workers=config.num_workers, pin_memory=config.pin_memory, collate_fn=dataset.collate)
+    else:
+        dataloader = DataLoader(dataset, sampler=BatchSampler(SequentialSampler(dataset), batch_size, drop_last=False), batch_size=None, num_workers=config.num_workers, pin_memory=config.pin_memory) # batches are gathered by the dataset
+    device = torch.device(config.device)
+    batches = Prefetcher(dataloader, device, config.prefetch_batch_num)
+    scores = torch.zeros([dataset.behaviors.candidate_num], device=device)
     index = 0
-    model.eval()
+    user_encoding_num = 0
+    user_encoding_time = 0
+    if eval_mode != 'pair':
+        candidate_positions = torch.from_numpy(dataset.candidate_positions).to(device)                            # [candidate_num], impressions are served grouped by user
     with torch.no_grad():
-        for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-             news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) in dataloader:
-            user_ID = user_ID.cuda(non_blocking=True)
-            user_category = user_category.cuda(non_blocking=True)
-            user_subCategory = user_subCategory.cuda(non_blocking=True)
-            user_title_text = user_title_text.cuda(non_blocking=True)
-            user_title_mask = user_title_mask.cuda(non_blocking=True)
-            user_title_entity = user_title_entity.cuda(non_blocking=True)
-            user_abstract_text = user_abstract_text.cuda(non_blocking=True)
-            user_abstract_mask = user_abstract_mask.cuda(non_blocking=True)
-            user_abstract_entity = user_abstract_entity.cuda(non_blocking=True)
-            user_history_mask = user_history_mask.cuda(non_blocking=True)
-            user_history_graph = user_history_graph.cuda(non_blocking=True)
-            user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)
-            user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)
-            news_category = news_category.cuda(non_blocking=True)
-            news_subCategory = news_subCategory.cuda(non_blocking=True)
-            news_title_text = news_title_text.cuda(non_blocking=True)
-            news_title_mask = news_title_mask.cuda(non_blocking=True)
-            news_title_entity = news_title_entity.cuda(non_blocking=True)
-            news_abstract_text = news_abstract_text.cuda(non_blocking=True)
-            news_abstract_mask = news_abstract_mask.cuda(non_blocking=True)
-            news_abstract_entity = news_abstract_entity.cuda(non_blocking=True)
-            batch_size = user_ID.size(0)
-            news_category = news_category.unsqueeze(dim=1)
-            news_subCategory = news_subCategory.unsqueeze(dim=1)
-            news_title_text = news_title_text.unsqueeze(dim=1)
-            news_title_mask = news_title_mask.unsqueeze(dim=1)
-            news_abstract_text = news_abstract_text.unsqueeze(dim=1)
-            news_abstract_mask = news_abstract_mask.unsqueeze(dim=1)
-            scores[index: index+batch_size] = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-                                                    news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity).squeeze(dim=1) # [batch_size]
-            index += batch_size
-    scores = scores.tolist()
-    sub_scores = [[] for _ in range(indices[-1] + 1)]
-    for i, index in enumerate(indices):
-        sub_scores[index].append([scores[i], len(sub_scores[index])])
-    with open(result_file, 'w', encoding='utf-8') as result_f:
-        for i, sub_score in enumerate(sub_scores):
-            sub_score.sort(key=lambda x: x[0], reverse=True)
-            result = [0 for _ in range(len(sub_score))]
-            for j in range(len(sub_score)):
-                result[sub_score[j][1]] = j + 1
-            result_f.write(('' if i == 0 else '\n') + str(i + 1) + ' ' + str(result).replace(' ', ''))
-    with open('./' + mode + '/ref/truth.txt', 'r', encoding='utf-8') as truth_f, open(result_file, 'r', encoding='utf-8') as result_f:
-        auc, mrr, ndcg, ndcg10 = scoring(truth_f, result_f)
+        if eval_mode == 'catalog':
+            for (user_ID, user_history_index, user_history_mask, user_history_category_mask, user_history_category_indices, user_index, candidate_news_mask, candidate_news_index) in batches:
+                synchronize(device)
+                start_time = time.time()
+                # each distinct user of the batch is encoded once, and the user state is shared by the impressions of the user
+                user_state = model.prepare_user(user_ID, news_table[user_history_index], user_history_mask, user_history_category_mask, user_history_category_indices)
+                user_state = tuple(state.index_select(0, user_index) for state in user_state)
+                synchronize(device)
+                user_encoding_time += time.time() - start_time
+                user_encoding_num += user_ID.size(0)
+                candidate_num = candidate_news_index.size(1)
+                chunk_size = get_candidate_chunk_size(model, config, user_index.size(0), candidate_num)
+                # oversized impressions are scored in candidate chunks against the same user state
+                logits = torch.cat([model.click_score(user_state, news_table[candidate_news_index[:, i: i+chunk_size]]) for i in range(0, candidate_num, chunk_size)], dim=1) # [batch_size, candidate_num]
+                logits = logits.masked_select(candidate_news_mask)                                                # [valid_candidate_num]
+                scores[candidate_positions[index: index+logits.size(0)]] = logits
+                index += logits.size(0)
+        elif eval_mode == 'impression':
+            for batch in batches:
+                if config.device_news_tables:
+                    # index batch of the catalog dataset, the news features are gathered from the device-resident news tables of the model
+                    (user_ID, user_history_index, user_history_mask, user_history_category_mask, user_history_category_indices, user_index, news_mask, news_index) = batch
+                    user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity = model.gather_news(user_history_index)
+                    news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity = model.gather_news(news_index)
+                else:
+                    (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
+                     user_index, news_mask, news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) = batch
+                synchronize(device)
+                start_time = time.time()
+                # the history of each distinct user of the batch is encoded once, and the candidates of the user's impressions are scored against it, in chunks if they exceed the memory budget
+                user_state, user_embedding = model.encode_user(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices)
+                user_state = tuple(state.index_select(0, user_index) for state in user_state)
+                user_embedding = user_embedding.index_select(0, user_index) if user_embedding is not None else None
+                synchronize(device)
+                user_encoding_time += time.time() - start_time
+                user_encoding_num += user_ID.size(0)
+                candidate_num = news_mask.size(1)
+                chunk_size = get_candidate_chunk_size(model, config, user_index.size(0), candidate_num)
+                logits = []
+                for i in range(0, candidate_num, chunk_size):
+                    j = min(i + chunk_size, candidate_num)
+                    news_features = [feature[:, i: j].contiguous() for feature in [news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity, news_category, news_subCategory]]
+                    news_representation = model.encode_news(*news_features, user_embedding) # [batch_size, chunk_size, news_embedding_dim]
+                    logits.append(model.click_score(user_state, news_representation)) # [batch_size, chunk_size]
+                logits = torch.cat(logits, dim=1) # [batch_size, candidate_num]
+                logits = logits.masked_select(news_mask) # [valid_candidate_num], the padded candidates are dropped in serving order
+                scores[candidate_positions[index: index+logits.size(0)]] = logits
+                index += logits.size(0)
+        else:
+            for batch in batches:
+                if config.device_news_tables:
+                    (user_ID, user_history_index, user_history_mask, user_history_category_mask, user_history_category_indices, news_index) = batch
+                    user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity = model.gather_news(user_history_index)
+                    news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity = model.gather_news(news_index)
+                else:
+                    (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
+                     news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) = batch
+                batch_size = user_ID.size(0)
+                news_category = news_category.unsqueeze(dim=1)
+                news_subCategory = news_subCategory.unsqueeze(dim=1)
+                news_title_text = news_title_text.unsqueeze(dim=1)
+                news_title_mask = news_title_mask.unsqueeze(dim=1)
+                news_abstract_text = news_abstract_text.unsqueeze(dim=1)
+                news_abstract_mask = news_abstract_mask.unsqueeze(dim=1)
+                scores[index: index+batch_size] = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_category_mask, user_history_category_indices, \
+                                                        news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity).squeeze(dim=1) # [batch_size]
+                index += batch_size
+    batches.report('Eval')
+    return scores.cpu().numpy(), user_encoding_num, user_encoding_time
+
+
+def print_user_dedupe(impression_num: int, user_encoding_num: int, user_encoding_time: float):
+    print('User dedupe : %d impressions, %d user encodings (dedupe ratio %.2f), user encoding time %.2fs, estimated time saved %.2fs' % \
+          (impression_num, user_encoding_num, impression_num / max(user_encoding_num, 1), user_encoding_time, user_encoding_time / max(user_encoding_num, 1) * (impression_num - user_encoding_num)))
+
+
+# Rank the candidates of each impression by descending score, the sort is stable so that tied candidates keep their original order
+# Input
+# scores             : [candidate_num]
+# impression_indices : [candidate_num] (the candidates of an impression are contiguous)
+# Output
+# ranks              : [candidate_num]
+# offsets            : [impression_num]
+def rank_scores(scores: np.ndarray, impression_indices: np.ndarray):
+    offsets = impression_offsets(impression_indices)                                                           # [impression_num]
+    lengths = np.diff(np.append(offsets, scores.shape[0]))                                                     # [impression_num]
+    order = np.lexsort((-scores, impression_indices))                                                          # [candidate_num]
+    ranks = np.empty([scores.shape[0]], dtype=np.int64)                                                        # [candidate_num]
+    ranks[order] = np.arange(scores.shape[0]) - np.repeat(offsets, lengths) + 1
+    return ranks, offsets
+
+
+# The evaluation dataset and the news representation table (catalog mode) can be passed in to be reused across calls, e.g., for the dev & test splits of several checkpoints
+def compute_scores(model: nn.Module, mind_corpus: MIND_Corpus, config: Config, mode: str, result_file: str, dataset: data.Dataset = None, news_table: torch.Tensor = None):
+    assert mode in ['dev', 'test'], 'mode must be choosen from \'dev\' or \'test\''
+    eval_mode = get_eval_mode(model, config)
+    dataset = dataset if dataset is not None else get_eval_dataset(mind_corpus, eval_mode, mode, index_only=config.device_news_tables)
+    model.eval()
+    if eval_mode == 'catalog' and news_table is None:
+        news_table = compute_news_table(model, mind_corpus, config)                                           # [news_num, news_embedding_dim]
+    scores, user_encoding_num, user_encoding_time = score_dataset(model, config, dataset, eval_mode, news_table) # [candidate_num]
+    if eval_mode != 'pair':
+        print_user_dedupe(len(dataset), user_encoding_num, user_encoding_time)
+    impression_indices = mind_corpus.dev_indices if mode == 'dev' else mind_corpus.test_indices               # [candidate_num]
+    ranks, offsets = rank_scores(scores, impression_indices)
+    if not config.no_result_file:
+        start_result_file_writer(result_file, impression_indices[offsets], ranks, offsets)
+    labels = mind_corpus.dev_labels if mode == 'dev' else mind_corpus.test_labels
+    auc, mrr, ndcg, ndcg10 = scoring_arrays(labels, ranks, offsets)
     return auc, mrr, ndcg, ndcg10
 
 
+# Stream the behaviors of behaviors_file in chunks of config.predict_impression_num impressions, and append the ranking result of each chunk to result_file as soon as it is scored,
+# so that the memory usage does not grow with the number of impressions (only the user dedupe is limited to the impressions of a chunk)
+def predict_scores(model: nn.Module, mind_corpus: MIND_Corpus, config: Config, behaviors_file: str, result_file: str):
+    eval_mode = get_eval_mode(model, config)
+    model.eval()
+    news_table = compute_news_table(model, mind_corpus, config) if eval_mode == 'catalog' else None           # [news_num, news_embedding_dim]
+    impression_num = 0
+    user_encoding_num = 0
+    user_encoding_time = 0
+    with open(result_file, 'w', encoding='utf-8') as result_f:
+        for chunk_index, behaviors in enumerate(mind_corpus.stream_behaviors(behaviors_file, config.predict_impression_num)):
+            dataset = get_eval_dataset(mind_corpus, eval_mode, 'test', behaviors, config.device_news_tables)
+            scores, _user_encoding_num, _user_encoding_time = score_dataset(model, config, dataset, eval_mode, news_table) # [chunk_candidate_num]
+            impression_indices = behaviors.impression_ID[behaviors.candidate_impression()]                     # [chunk_candidate_num]
+            ranks, offsets = rank_scores(scores, impression_indices)
+            result_f.write(('\n' if chunk_index > 0 else '') + format_result_lines(impression_indices[offsets], ranks, offsets))
+            impression_num += offsets.shape[0]
+            user_encoding_num += _user_encoding_num
+            user_encoding_time += _user_encoding_time
+    if eval_mode != 'pair':
+        print_user_dedupe(impression_num, user_encoding_num, user_encoding_time)
+    return impression_num
+
+
+# Ranking result lines in the submission format of the MIND benchmark, e.g., `1 [2,1,3]`
+def format_result_lines(impression_IDs: np.ndarray, ranks: np.ndarray, offsets: np.ndarray):
+    ranks = ranks.tolist()
+    ends = offsets[1:].tolist() + [len(ranks)]
+    return '\n'.join(str(impression_ID + 1) + ' [' + ','.join(map(str, ranks[start: end])) + ']' for impression_ID, start, end in zip(impression_IDs.tolist(), offsets.tolist(), ends))
+
+
+def write_result_file(result_file: str, impression_IDs: np.ndarray, ranks: np.ndarray, offsets: np.ndarray):
+    with open(result_file, 'w', encoding='utf-8') as result_f:
+        result_f.write(format_result_lines(impression_IDs, ranks, offsets))
+
+
+# The result file of compute_scores is written on a background thread while the evaluation goes on, the previous writer is joined before a new one starts,
+# so that the writes of the same path never overlap, and join_result_file_writer must be called before the process exits
+result_file_writer = None
+
+
+def start_result_file_writer(result_file: str, impression_IDs: np.ndarray, ranks: np.ndarray, offsets: np.ndarray):
+    global result_file_writer
+    join_result_file_writer()
+    result_file_writer = threading.Thread(target=write_result_file, args=(result_file, impression_IDs, ranks, offsets))
+    result_file_writer.start()
+
+
+def join_result_file_writer():
+    global result_file_writer
+    if result_file_writer is not None:
+        result_file_writer.join()
+        result_file_writer = None
+
+
 def try_to_install_torch_scatter_package():
     try:
         import torch_scatter # already installed
@@ -95,6 +350,8 @@ def try_to_install_torch_scatter_package():
                     break
         if os.path.exists(temp_gpu_info_file):
             os.remove(temp_gpu_info_file)
+        if cuda_version is None and not torch.cuda.is_available():
+            cuda_version = 'cpu' # CPU-only wheels
         install_flag = False
         if cuda_version is not None:
             try: